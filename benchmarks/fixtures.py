@@ -0,0 +1,72 @@
+import os
+import numpy as np
+from ionoptics import beamline as bl
+
+
+# synthetic beam lines
+
+def beamline(n,dec=2,k=2.):
+    '''FODO-like beam line of n elements (drift, qf, drift, qdf, ...)
+    @param n: int, number of elements
+    @param dec: int, decimals of the lengths, sets the sampling step of Mplot (10**-dec)
+    @param k: float, quadrupole strength
+    @return: elements (w/ partials), lengths'''
+
+    elements,lengths = quad_line(n,dec)
+    elements = bl.eles_to_peles(elements,[k]*n,S=False)
+
+    return elements,lengths
+
+def quad_line(n,dec=2):
+    '''beam line of n elements with free quadrupoles, as input for opt_quad_mult
+    @return: elements (w/o partials), lengths'''
+
+    rng = np.random.default_rng(n)
+
+    elements = []
+    lengths = []
+    for i in range(n):
+        if i % 4 == 1:
+            elements.append(bl.qf)
+        elif i % 4 == 3:
+            elements.append(bl.qdf)
+        else:
+            elements.append(bl.drift)
+        lengths.append(round(rng.uniform(0.2,1.),dec))
+    # at least one length w/ exactly dec decimals
+    lengths[0] = round(0.1+10**-dec,dec)
+
+    return elements,lengths
+
+# synthetic Bmad tracking output
+
+def tracking_file(directory,rows,n_ele=20):
+    '''write synthetic tracking_ele file with given number of rows (once)
+    @param directory: target directory
+    @param rows: int, number of rows
+    @param n_ele: int, number of elements incl. beginning
+    @return: PATH_TO_DATA, FILENAME as for bmad.txt_to_df'''
+
+    filename = 'tracking_{}.txt'.format(rows)
+    path = os.path.join(directory,filename)
+
+    if not os.path.exists(path):
+        rng = np.random.default_rng(rows)
+        n = max(rows//n_ele,1)
+        with open(path+'.tmp','w') as f:
+            for start in range(0,rows,10**6):
+                idx = np.arange(start,min(start+10**6,rows))
+                ele = idx//n
+                coords = rng.normal(0,1e-3,size=(len(idx),4))
+                coords[rng.random(len(idx)) < 0.01] = 0
+                lines = ['{} {} E{} {:.4f} {:.6e} {:.6e} {:.6e} {:.6e}\n'.format(i,int(e > 0),e,0.5*e,*c)
+                         for i,e,c in zip(idx.tolist(),ele.tolist(),coords.tolist())]
+                f.writelines(lines)
+        os.replace(path+'.tmp',path)
+
+    return directory+os.sep,filename
+
+def particles(n,seed=0):
+    '''gaussian (n,4) particle distribution'''
+
+    return np.random.default_rng(seed).normal(0,1e-3,size=(n,4))
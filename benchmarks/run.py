@@ -0,0 +1,273 @@
+'''benchmark suite of the ion-optics and analysis hot paths
+
+usage:
+    python -m benchmarks.run [--full] [--filter NAME] [--timeout SECONDS] [--out FILE.json] [--compare OLD.json]
+
+every case reports the best wall time of a few repetitions and the peak memory (tracemalloc)
+of one extra run; results of two commits are compared with --compare. cases of APIs missing
+in the checked out commit are skipped, cases exceeding --timeout are reported as timeout.
+'''
+import argparse
+import inspect
+import json
+import os
+import platform
+import signal
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from helpers import numerics as num
+from ionoptics import beamline as bl
+from ionoptics import bmad
+from ionoptics import geometry as geo
+from benchmarks import fixtures
+
+
+# cases: (group, size, case, run) with run() the function to be timed, None if not available
+
+def available(func,*params):
+    '''func exists and has the named parameters, e.g. available(bl.Mplot,'max_points')
+    (APIs of later commits are missing when older commits are benchmarked for --compare)'''
+
+    if func is None:
+        return False
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError,ValueError):
+        return False
+
+    return all(param in parameters for param in params)
+
+def cases(full,data_dir):
+
+    max_samples = 2*10**7 if full else 2*10**5
+
+    # Mplot and plot_M_vs_s: line length and sampling resolution (cm to um)
+    for n in [5,50,500]:
+        for dec in [2,3,4,6]:
+            elements,lengths = fixtures.beamline(n,dec)
+            samples = sum(lengths)*10**dec
+            if samples > max_samples:
+                continue
+            yield 'Mplot',int(samples),'n={} step=1e-{}'.format(n,dec),_setup_mplot(elements,lengths)
+    # bounded sample count, independent of the decimals of the lengths
+    for n in [5,50,500]:
+        elements,lengths = fixtures.beamline(n,6)
+        yield ('Mplot_max_points',n,'n={} max_points=1e4'.format(n),
+               _setup_mplot(elements,lengths,max_points=10**4) if available(bl.Mplot,'max_points') else None)
+        yield ('Mplot_adaptive',n,'n={} adaptive'.format(n),
+               _setup_mplot(elements,lengths,max_points=10**4,adaptive=True) if available(bl.Mplot,'max_points','adaptive') else None)
+    # array output and streaming
+    for dec in [3,4]:
+        elements,lengths = fixtures.beamline(50,dec)
+        samples = sum(lengths)*10**dec
+        if samples > max_samples:
+            continue
+        yield ('Mplot_array',int(samples),'n=50 step=1e-{}'.format(dec),
+               _setup_mplot(elements,lengths,output='array') if available(bl.Mplot,'output') else None)
+        yield ('Mplot_chunks',int(samples),'n=50 step=1e-{}'.format(dec),
+               _setup_chunks(elements,lengths) if available(getattr(bl,'Mplot_chunks',None),'entries') else None)
+    for n in [5,50]:
+        elements,lengths = fixtures.beamline(n,3)
+        yield 'plot_M_vs_s',n,'n={}'.format(n),_setup_plot_M(elements,lengths)
+
+    # quadrupole matching
+    for n in [7,15,31] if full else [7,15]:
+        elements,lengths = fixtures.quad_line(n,2)
+        yield 'opt_quad_mult',n,'n={}'.format(n),_setup_opt(elements,lengths)
+
+    # Bmad tracking output
+    for rows in [10**3,10**5,10**7] if full else [10**3,10**5]:
+        path,filename = fixtures.tracking_file(data_dir,rows)
+        cache = available(bmad.txt_to_df,'cache')
+        yield 'txt_to_df',rows,'rows={} parse'.format(rows),_setup_txt(path,filename,False if cache else None)
+        yield 'txt_to_df_cached',rows,'rows={} cached'.format(rows),_setup_txt(path,filename,True) if cache else None
+        if rows <= (10**6 if full else 10**5):
+            yield 'plot_phase_space',rows,'rows={}'.format(rows),_setup_pps(path,filename,'scatter')
+        yield ('plot_phase_space_hist',rows,'rows={} hist'.format(rows),
+               _setup_pps(path,filename,'hist') if available(bmad.plot_phase_space,'mode') else None)
+
+    # kick angle search
+    for step in [1e-3,1e-4] if full else [1e-3]:
+        yield 'iterate',int(1/step),'step={:g}'.format(step),_setup_iterate(num.iterate,step)
+        yield 'solve',int(1/step),'step={:g}'.format(step),_setup_iterate(num.solve,step) if hasattr(num,'solve') else None
+
+def _setup_mplot(elements,lengths,**sampling):
+    return lambda: bl.Mplot(elements,lengths,**sampling)
+
+def _setup_chunks(elements,lengths):
+    # reduce on the fly: max. |M12|, |M34|
+    return lambda: max(np.abs(M).max() for s,M in bl.Mplot_chunks(elements,lengths,chunksize=10**4,entries=['M12','M34']))
+
+def _setup_plot_M(elements,lengths):
+    def run():
+        bl.plot_M_vs_s(elements,lengths)
+        plt.close('all')
+    return run
+
+def _setup_opt(elements,lengths):
+    def run():
+        with open(os.devnull,'w') as devnull:
+            _quiet(devnull,bl.opt_quad_mult,elements,lengths,S=False)
+    return run
+
+def _setup_txt(path,filename,cache):
+    # cache None: txt_to_df w/o cache
+    if cache is None:
+        return lambda: bmad.txt_to_df(path,filename)
+    if cache:
+        bmad.txt_to_df(path,filename)
+    return lambda: bmad.txt_to_df(path,filename,cache=cache)
+
+def _setup_pps(path,filename,mode):
+    df = bmad.txt_to_df(path,filename)
+    kwargs = {'mode':mode} if available(bmad.plot_phase_space,'mode') else {}
+    def run():
+        with open(os.devnull,'w') as devnull:
+            _quiet(devnull,bmad.plot_phase_space,df,figsize=(12,6),**kwargs)
+        plt.close('all')
+    return run
+
+def _setup_iterate(solver,step):
+    x_sept = 4*7e-3
+    x_add = 0.1-x_sept
+    func = lambda perm,kick: geo.s_kick_sept(x_sept,x_add,0,kick,perm,0,0.5,0.5,'DC')
+    perms = np.linspace(0,1,101)
+    return lambda: solver(func,perms,step,step,2)
+
+def _quiet(stream,func,*args,**kwargs):
+    from contextlib import redirect_stdout
+    with redirect_stdout(stream):
+        return func(*args,**kwargs)
+
+# measurement
+
+class Timeout(Exception):
+    pass
+
+def _alarm(signum,frame):
+    raise Timeout()
+
+def measure(run,repeat=3,min_time=0.2,timeout=None):
+    '''best wall time of repeat runs (more for fast cases) and peak memory of one run
+    @param timeout: float, max. total seconds of the case (not enforced w/o SIGALRM, e.g. on Windows),
+                    raises Timeout'''
+
+    capped = timeout is not None and hasattr(signal,'SIGALRM')
+    if capped:
+        handler = signal.signal(signal.SIGALRM,_alarm)
+        signal.setitimer(signal.ITIMER_REAL,timeout)
+
+    try:
+        times = []
+        while len(times) < repeat or (sum(times) < min_time and len(times) < 100):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter()-start)
+
+        tracemalloc.start()
+        try:
+            run()
+            _,peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        if capped:
+            signal.setitimer(signal.ITIMER_REAL,0)
+            signal.signal(signal.SIGALRM,handler)
+
+    return min(times),peak
+
+def scaling(results):
+    '''exponent of time ~ size**a per group, fitted in log-log'''
+
+    results = [r for r in results if r['time'] is not None]
+
+    exponents = {}
+    for group in sorted(set(r['group'] for r in results)):
+        size = np.array([r['size'] for r in results if r['group'] == group],dtype=float)
+        t = np.array([r['time'] for r in results if r['group'] == group])
+        if len(np.unique(size)) > 1:
+            exponents[group] = float(np.polyfit(np.log(size),np.log(t),1)[0])
+
+    return exponents
+
+def compare(results,old,threshold=1.2):
+    '''print time ratio new/old per case, flag slower cases'''
+
+    old = {(r['group'],r['case']):r for r in old['results']}
+    print('\n{:<24}{:<24}{:>10}{:>10}'.format('group','case','t/t_old','m/m_old'))
+    for r in results:
+        ref = old.get((r['group'],r['case']))
+        if ref is None or ref['time'] is None or r['time'] is None:
+            continue
+        ratio_t = r['time']/ref['time']
+        ratio_m = r['peak_memory']/max(ref['peak_memory'],1)
+        flag = '  <-- slower' if ratio_t > threshold else ''
+        print('{:<24}{:<24}{:>10.2f}{:>10.2f}{}'.format(r['group'],r['case'],ratio_t,ratio_m,flag))
+
+def commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--full',action='store_true',help='large cases (up to 1e7 rows, um resolution)')
+    parser.add_argument('--filter',default=None,help='run only groups containing this string')
+    parser.add_argument('--data-dir',default=os.path.join(tempfile.gettempdir(),'ionoptics_bench'),help='directory of synthetic tracking files')
+    parser.add_argument('--timeout',type=float,default=60.,help='max. seconds per case')
+    parser.add_argument('--out',default=None,help='write results as json')
+    parser.add_argument('--compare',default=None,help='json of a previous run')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir,exist_ok=True)
+
+    results = []
+    print('{:<24}{:<24}{:>12}{:>14}'.format('group','case','time [s]','peak [MB]'))
+    for group,size,case,run in cases(args.full,args.data_dir):
+        if args.filter is not None and args.filter not in group:
+            continue
+        if run is None:
+            print('{:<24}{:<24}{:>12}'.format(group,case,'n/a'))
+            continue
+        try:
+            t,peak = measure(run,timeout=args.timeout)
+        except Timeout:
+            results.append({'group':group,'case':case,'size':size,'time':None,'peak_memory':None})
+            print('{:<24}{:<24}{:>12}'.format(group,case,'timeout'))
+            plt.close('all')
+            continue
+        except Exception as err:
+            # e.g. older commits with APIs removed from pandas
+            print('{:<24}{:<24}{:>12}  {}: {}'.format(group,case,'error',type(err).__name__,err))
+            plt.close('all')
+            continue
+        results.append({'group':group,'case':case,'size':size,'time':t,'peak_memory':peak})
+        print('{:<24}{:<24}{:>12.4g}{:>14.2f}'.format(group,case,t,peak/1e6))
+
+    exponents = scaling(results)
+    print('\nscaling exponent (time ~ size**a):')
+    for group,a in exponents.items():
+        print('  {:<24}{:>6.2f}'.format(group,a))
+
+    report = {'commit':commit(),'python':platform.python_version(),'numpy':np.__version__,
+              'full':args.full,'results':results,'scaling':exponents}
+
+    if args.out is not None:
+        with open(args.out,'w') as f:
+            json.dump(report,f,indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import warnings
+import numpy as np
+
 def iterate(func,list_var1,start_var2,step_var2,limit,below=True):
     '''brute force to iterate to solution
     @param func: function with 2 free parameters
@@ -26,4 +29,89 @@ def iterate(func,list_var1,start_var2,step_var2,limit,below=True):
             
             d[var1] = round(var2,3)
     
-    return d
\ No newline at end of file
+    return d
+
+def solve(func,list_var1,start_var2,step_var2,limit,below=True,tol=1e-6,grid=64,max_doublings=64):
+    '''vectorized counterpart of iterate: first var2 >= start_var2 at which func falls below / overshoots the threshold,
+    for all entries of list_var1 at once
+    search: grid of grid+1 points on [start_var2, start_var2 + grid*step_var2], the range is doubled until the threshold
+    is reached at a grid point; the first bracket of grid points is refined on sub-grids down to the width step_var2,
+    then bisected to tol. The cost grows with log(1/step_var2) only; crossings narrower than the grid spacing of the
+    search are not resolved (as crossings within a step in iterate)
+    @param func: function with 2 free parameters, evaluated on broadcast arrays (first value used if a tuple is returned)
+    @param list_var1: parameter space of 1st variable
+    @param start_var2: initial value of 2nd variable 
+    @param step_var2: resolution of the search for the first crossing
+    @param limit: threshold to fall below (default) / overshoot
+    @param below: fall below threshold (default)
+    @param tol: absolute tolerance of 2nd variable
+    @param grid: int, number of grid intervals of the search and refinement
+    @param max_doublings: int, max. number of doublings of the searched range, nan (with a warning)
+                          if the threshold is not reached
+    @return: dict, {var1: var2}'''
+
+    var1 = np.asarray(list_var1,dtype=float)
+    frac = np.arange(grid+1)/grid
+
+    def reached(v1,var2):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            f = func(v1,var2)
+            if isinstance(f,tuple):
+                f = f[0]
+            f = np.broadcast_to(f,np.broadcast(v1,var2).shape)
+            return f < limit if below else f > limit
+
+    def first(v1,pts):
+        '''index of first reached grid point of each row, -1 if none'''
+        ok = reached(v1[:,None],pts)
+        return np.where(ok.any(axis=1),ok.argmax(axis=1),-1)
+
+    # search: lo not reached, hi reached
+    lo = np.full(var1.shape,np.nan)
+    hi = np.full(var1.shape,np.nan)
+    searching = np.ones(var1.shape,dtype=bool)
+    span = grid*step_var2
+    for _ in range(max_doublings+1):
+        if not searching.any():
+            break
+        pts = start_var2+span*frac
+        j = first(var1[searching],np.broadcast_to(pts,(searching.sum(),grid+1)))
+        idx = np.flatnonzero(searching)[j >= 0]
+        j = j[j >= 0]
+        hi[idx] = pts[j]
+        lo[idx] = np.where(j > 0,pts[np.maximum(j-1,0)],pts[0])
+        searching[idx] = False
+        span *= 2
+
+    if searching.any():
+        warnings.warn('threshold not reached within {:g} of start_var2 for {} of {} values of var1'.format(
+            span/2,searching.sum(),len(var1)),RuntimeWarning)
+
+    # refinement of the first bracket: first reached point on a sub-grid
+    active = np.isfinite(hi) & (hi != lo)
+    while True:
+        active &= np.abs(hi-lo) > abs(step_var2)
+        if not active.any():
+            break
+        pts = lo[active,None]+(hi-lo)[active,None]*frac
+        pts[:,-1] = hi[active]
+        # lo not reached, hi reached: 1 <= j <= grid
+        j = first(var1[active],pts)
+        j = np.where(j < 0,grid,np.maximum(j,1))
+        rows = np.arange(len(j))
+        hi[active],lo[active] = pts[rows,j],pts[rows,j-1]
+
+    # bisection of all brackets simultaneously
+    active = np.isfinite(hi) & (hi != lo)
+    for _ in range(int(np.ceil(np.log2(max(abs(step_var2)/tol,1))))+1):
+        if not active.any():
+            break
+        mid = (lo+hi)/2
+        # stop at the resolution of float
+        active &= (mid != lo) & (mid != hi)
+        ok = reached(var1,mid)
+        hi = np.where(active & ok,mid,hi)
+        lo = np.where(active & ~ok,mid,lo)
+        active &= np.abs(hi-lo) > tol
+
+    return dict(zip(list_var1,hi.tolist()))
@@ -0,0 +1 @@
+from ionoptics.profiling import profile
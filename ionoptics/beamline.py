@@ -1,12 +1,35 @@
+import math
 import numpy as np
 from matplotlib import pyplot as plt
 import scipy.optimize as sco
 from functools import partial
+from ionoptics import profiling as prof
 
 
 # ion optical elements
+# all elements accept scalars or arrays for L and k (and the dipole parameters);
+# arrays are broadcast against each other and give a (N,4,4) stack of matrices
 
-def qf(L,k,t=False):
+def matrix(M11,M12,M21,M22,M33,M34,M43,M44,compact=False):
+    '''assemble uncoupled transport matrix from horizontal and vertical entries
+    @param M11...M44: scalars or arrays (broadcast against each other)
+    @param compact: True - return plane blocks, see blocks
+    @return: (4,4) array for scalar entries, (...,4,4) stack for array entries'''
+    if compact:
+        return blocks(M11,M12,M21,M22,M33,M34,M43,M44)
+
+    entries = np.broadcast_arrays(M11,M12,M21,M22,M33,M34,M43,M44)
+
+    if entries[0].ndim == 0:
+        return np.array([[M11,M12,0,0],[M21,M22,0,0],[0,0,M33,M34],[0,0,M43,M44]])
+
+    M = np.zeros(entries[0].shape+(4,4),dtype=np.result_type(*entries,float))
+    for (r,c),entry in zip([(0,0),(0,1),(1,0),(1,1),(2,2),(2,3),(3,2),(3,3)],entries):
+        M[...,r,c] = entry
+
+    return M
+
+def qf(L,k,t=False,compact=False):
     
     c = np.cos(np.sqrt(k)*L)
     s = np.sin(np.sqrt(k)*L)
@@ -37,11 +60,13 @@ def qf(L,k,t=False):
     
     
     
-    M = np.array([[M11,M12,0,0],[M21,M22,0,0],[0,0,M33,M34],[0,0,M43,M44]])
+    M = matrix(M11,M12,M21,M22,M33,M34,M43,M44,compact)
     
+    prof.count('element_matrices',np.size(M)//(8 if compact else 16))
+
     return M
 
-def qdf(L,k,t=False):
+def qdf(L,k,t=False,compact=False):
     
     ch = np.cosh(np.sqrt(k)*L)
     sh = np.sinh(np.sqrt(k)*L)
@@ -72,11 +97,56 @@ def qdf(L,k,t=False):
     
     
     
-    M = np.array([[M11,M12,0,0],[M21,M22,0,0],[0,0,M33,M34],[0,0,M43,M44]])
+    M = matrix(M11,M12,M21,M22,M33,M34,M43,M44,compact)
     
+    prof.count('element_matrices',np.size(M)//(8 if compact else 16))
+
+    return M
+
+def dqf(L,k,t=False):
+    '''derivative of qf transport matrix with respect to k'''
+
+    c = np.cos(np.sqrt(k)*L)
+    s = np.sin(np.sqrt(k)*L)
+
+    ch = np.cosh(np.sqrt(k)*L)
+    sh = np.sinh(np.sqrt(k)*L)
+
+    M11 = -L*s/(2*np.sqrt(k))
+    M12 = L*c/(2*k) - s/(2*k*np.sqrt(k))
+    M21 = -s/(2*np.sqrt(k)) - L*c/2
+    M22 = M11
+
+    M33 = L*sh/(2*np.sqrt(k))
+    M34 = L*ch/(2*k) - sh/(2*k*np.sqrt(k))
+    M43 = sh/(2*np.sqrt(k)) + L*ch/2
+    M44 = M33
+
+    if t:
+        M11 = 0
+        M12 = 0
+        M21 = -L
+        M22 = 0
+
+        M33 = 0
+        M34 = 0
+        M43 = L
+        M44 = 0
+
+    M = matrix(M11,M12,M21,M22,M33,M34,M43,M44)
+
+    return M
+
+def dqdf(L,k,t=False):
+    '''derivative of qdf transport matrix with respect to k'''
+
+    M = dqf(L,k,t)
+    # defocusing in x is focusing in y: swap planes
+    M = M[...,[2,3,0,1],:][...,:,[2,3,0,1]]
+
     return M
 
-def drift(L):
+def drift(L,compact=False):
     
     M11 = 1
     M12 = L
@@ -88,16 +158,19 @@ def drift(L):
     M43 = 0
     M44 = 1
     
-    M = np.array([[M11,M12,0,0],[M21,M22,0,0],[0,0,M33,M34],[0,0,M43,M44]])
+    M = matrix(M11,M12,M21,M22,M33,M34,M43,M44,compact)
     
+    prof.count('element_matrices',np.size(M)//(8 if compact else 16))
+
     return M
 
 
 
-def dipole(L,L_max,alpha,beta_s=0,beta_e=0):
-    '''@ param L: scalar, length of path in dipole
-       @ param alpha: scalar, bending angle in rad
-       @ param beta: face angle in rad, 0 for SBEND (default), alpha/2 for RBEND, (larger, outer arc smaller)'''
+def dipole(L,L_max,alpha,beta_s=0,beta_e=0,compact=False):
+    '''@ param L: scalar or array, length of path in dipole
+       @ param alpha: scalar or array, bending angle in rad
+       @ param beta: face angle in rad, 0 for SBEND (default), alpha/2 for RBEND, (larger, outer arc smaller)
+       @ param compact: True - return plane blocks, see blocks'''
 
     rho_0 = L_max/alpha
 
@@ -113,7 +186,7 @@ def dipole(L,L_max,alpha,beta_s=0,beta_e=0):
     E43 = -np.tan(beta_s)/rho_0 #TODO: just approx.
     E44 = 1
     
-    E_s = np.array([[E11,E12,0,0],[E21,E22,0,0],[0,0,E33,E34],[0,0,E43,E44]])
+    E_s = matrix(E11,E12,E21,E22,E33,E34,E43,E44,compact)
 
     E11 = 1
     E12 = 0
@@ -125,7 +198,7 @@ def dipole(L,L_max,alpha,beta_s=0,beta_e=0):
     E43 = -np.tan(beta_e)/rho_0 #TODO: just approx.
     E44 = 1
     
-    E_e = np.array([[E11,E12,0,0],[E21,E22,0,0],[0,0,E33,E34],[0,0,E43,E44]])
+    E_e = matrix(E11,E12,E21,E22,E33,E34,E43,E44,compact)
 
 
 
@@ -139,9 +212,9 @@ def dipole(L,L_max,alpha,beta_s=0,beta_e=0):
     M43 = 0
     M44 = 1
 
-    M = np.array([[M11,M12,0,0],[M21,M22,0,0],[0,0,M33,M34],[0,0,M43,M44]])
+    M = matrix(M11,M12,M21,M22,M33,M34,M43,M44,compact)
 
-    M = bl([E_s,M,E_e])
+    M = bl_blocks([E_s,M,E_e]) if compact else bl_stack([E_s,M,E_e])
     #TODO: this gives the right result at the end but however
     # is wrong for plotting since all elements plotted have edge
     # focusing effects which only occur at the beg/end. 
@@ -152,12 +225,15 @@ def dipole(L,L_max,alpha,beta_s=0,beta_e=0):
 
 
     
+    prof.count('element_matrices',np.size(M)//(8 if compact else 16))
+
     return M    
 
 # transport matrix of beamline
     
 def bl(matrices):
     '''@ param matrices: list starting with first transport matrix'''
+    prof.count('matrix_products',len(matrices)-1)
     for index in range(len(matrices)):
         try:
             matrices[index+1] = np.matmul(matrices[index+1],matrices[index])
@@ -165,15 +241,150 @@ def bl(matrices):
     
     return matrices[-1]
 
+def bl_stack(matrices):
+    '''transport matrix of beamline for single matrices or stacks, list is not modified
+    @param matrices: list starting with first transport matrix, (4,4) or (...,4,4) arrays
+    @return: product of all matrices, broadcast over stack dimensions'''
+    prof.count('matrix_products',len(matrices)-1)
+    M = matrices[0]
+    for M_next in matrices[1:]:
+        M = np.matmul(M_next,M)
+
+    return M
+
+def prefix(matrices):
+    '''cumulative transport matrices at the entrance of each element
+    @param matrices: list starting with first transport matrix
+    @return: list, i-th entry is product of matrices[:i] (identity for i = 0)'''
+    prof.count('matrix_products',len(matrices)-1)
+    M_pre = [np.identity(4)]
+    for M in matrices[:-1]:
+        M_pre.append(np.matmul(M,M_pre[-1]))
+
+    return M_pre
+
+def prefix_blocks(matrices):
+    '''prefix for plane blocks
+    @param matrices: list starting with first transport matrix, (2,2,2) arrays
+    @return: list, i-th entry is product of matrices[:i] (identity for i = 0)'''
+    prof.count('matrix_products',len(matrices)-1)
+    B_pre = [to_blocks(np.identity(4))]
+    for B in matrices[:-1]:
+        B_pre.append(mul_blocks(B,B_pre[-1]))
+
+    return B_pre
+
+# compact representation of uncoupled transport matrices:
+# the horizontal and vertical 2x2 blocks as (2,2,2) array [plane,row,column],
+# stacks keep the stack dimensions last (2,2,2,...), so each matrix entry is a contiguous array
+
+def blocks(M11,M12,M21,M22,M33,M34,M43,M44):
+    '''assemble plane blocks from horizontal and vertical entries
+    @param M11...M44: scalars or arrays (broadcast against each other)
+    @return: (2,2,2) array for scalar entries, (2,2,2,...) stack for array entries'''
+    entries = np.broadcast_arrays(M11,M12,M21,M22,M33,M34,M43,M44)
+
+    return np.array(entries,dtype=np.result_type(*entries,float)).reshape((2,2,2)+entries[0].shape)
+
+class CoupledError(ValueError):
+    '''transport matrix with entries between the planes, has no block representation'''
+
+def is_uncoupled(M):
+    '''True if the (4,4) matrix or (...,4,4) stack has no entries between the planes'''
+    M = np.asarray(M)
+
+    return not (np.any(M[...,0:2,2:4]) or np.any(M[...,2:4,0:2]))
+
+def is_uncoupled_line(blist,llist):
+    '''True if all elements have a plane block representation: elements of this module
+    (built as blocks directly) and other elements with an uncoupled matrix at their length
+    @param blist: list of functions of ion optical elements (w/ partials)
+    @param llist: list of lenghts of ion optical elements'''
+
+    return all(_function(ele) in _compact or is_uncoupled(ele(l)) for ele,l in zip(blist,llist))
+
+def to_blocks(M):
+    '''convert dense transport matrix to plane blocks
+    @param M: (4,4) matrix or (...,4,4) stack, uncoupled (CoupledError otherwise)
+    @return: (2,2,2) or (2,2,2,...) array'''
+    M = np.asarray(M,dtype=float)
+    if not is_uncoupled(M):
+        raise CoupledError('coupled transport matrix has no block representation')
+
+    B = np.stack([M[...,0:2,0:2],M[...,2:4,2:4]])
+
+    return np.moveaxis(B,range(1,B.ndim-2),range(3,B.ndim))
+
+def from_blocks(B):
+    '''convert plane blocks to dense transport matrix
+    @param B: (2,2,2) or (2,2,2,...) array
+    @return: (4,4) matrix or (...,4,4) stack'''
+    B = np.asarray(B)
+
+    M = np.zeros(B.shape[3:]+(4,4),dtype=B.dtype)
+    M[...,0:2,0:2] = np.moveaxis(B[0],(0,1),(-2,-1))
+    M[...,2:4,2:4] = np.moveaxis(B[1],(0,1),(-2,-1))
+
+    return M
+
+def mul_blocks(B2,B1):
+    '''product B2 B1 of plane blocks (B1 is passed first), stack dimensions broadcast'''
+    if np.ndim(B1) == 3 and np.ndim(B2) == 3:
+        return np.matmul(B2,B1)
+
+    return np.einsum('pik...,pkj...->pij...',B2,B1)
+
+def bl_blocks(matrices):
+    '''transport matrix of beamline in plane blocks, as bl_stack
+    @param matrices: list starting with first transport matrix, (2,2,2) or (2,2,2,...) arrays
+    @return: product of all matrices'''
+    prof.count('matrix_products',len(matrices)-1)
+    B = matrices[0]
+    for B_next in matrices[1:]:
+        B = mul_blocks(B_next,B)
+
+    return B
+
+def element_stack(ele,L):
+    '''transport matrices of an ion optical element at one or many lengths, elements written for scalar
+    lengths (no (n,4,4) stack for an array of lengths) are evaluated length by length
+    @param ele: function of ion optical element (w/ partial)
+    @param L: scalar or 1D array, length
+    @return: (4,4) or (len(L),4,4) array'''
+    if np.ndim(L) == 0 or _function(ele) in _compact:
+        return ele(L)
+
+    try:
+        M = ele(L)
+    except (TypeError,ValueError):
+        M = None
+    if np.shape(M) != (len(L),4,4):
+        M = np.array([ele(l) for l in L],dtype=float).reshape(len(L),4,4)
+
+    return M
+
+def element_blocks(ele,L):
+    '''plane blocks of an ion optical element, built directly for the elements of this module,
+    converted from the dense matrix otherwise (CoupledError for coupled elements)
+    @param ele: function of ion optical element (w/ partial)
+    @param L: scalar or array, length'''
+    if _function(ele) in _compact:
+        return ele(L,compact=True)
+
+    return to_blocks(element_stack(ele,L))
+
 # main planes of thick lens
 
 def zplanes(matrix):
+    '''@param matrix: (4,4) transport matrix or (...,4,4) stack'''
+
+    matrix = np.asarray(matrix)
 
-    z1x = (matrix[1][1]-1)/matrix[1][0]
-    z2x = (matrix[0][0]-1)/matrix[1][0]
+    z1x = (matrix[...,1,1]-1)/matrix[...,1,0]
+    z2x = (matrix[...,0,0]-1)/matrix[...,1,0]
     
-    z1y = (matrix[3][3]-1)/matrix[3][2]
-    z2y = (matrix[2][2]-1)/matrix[3][2]
+    z1y = (matrix[...,3,3]-1)/matrix[...,3,2]
+    z2y = (matrix[...,2,2]-1)/matrix[...,3,2]
     
     return (z1x,z2x),(z1y,z2y)
 
@@ -196,101 +407,448 @@ def thin(matrix):
 
 # calculate s-dependent matrix elements
 
-def Mplot(blist,llist):
+@prof.timed
+def Mstack(blist,llist,step=None,max_points=None,adaptive=False):
+    '''calculate s-dependent transport matrices of given beam line as one stack.
+    @param blist: list of functions of ion optical elements (evaluated at arrays of lengths, see element_stack)
+    @param llist: list of lenghts of ion optical elements
+    @param step, max_points, adaptive: sampling, see sample_points
+    @return:
+        s: propagation
+        M: (n,4,4) array, transport matrix at each s
+    '''
+    if not is_uncoupled_line(blist,llist):
+        return _Mstack_dense(blist,llist,step,max_points,adaptive)
+
+    s,B = Mblocks(blist,llist,step,max_points,adaptive)
+
+    return s,from_blocks(B)
+
+@prof.timed
+def Mblocks(blist,llist,step=None,max_points=None,adaptive=False):
+    '''calculate s-dependent transport matrices of given beam line as plane blocks, see Mstack
+    @return:
+        s: propagation
+        B: (2,2,2,n) array, plane blocks at each s, see blocks
+    raises CoupledError for coupled elements'''
+    positions,s = sample_points(blist,llist,step,max_points,adaptive)
+
+    B_static = [element_blocks(ele,length) for ele,length in zip(blist,llist)]
+    B_pre = prefix_blocks(B_static)
+    # evaluate each element at all sample lengths at once and multiply onto cumulative matrix at element entrance
+    B = np.concatenate([mul_blocks(element_blocks(ele,pos),B_pre[i]) for i,(ele,pos) in enumerate(zip(blist,positions))],axis=-1)
+    prof.count('matrix_products',len(blist))
+
+    return s,B
+
+def _Mstack_dense(blist,llist,step=None,max_points=None,adaptive=False):
+
+    positions,s = sample_points(blist,llist,step,max_points,adaptive)
+
+    M_static = [ele(length) for ele,length in zip(blist,llist)]
+    M_pre = prefix(M_static)
+    M = np.concatenate([np.matmul(element_stack(ele,pos),M_pre[i]) for i,(ele,pos) in enumerate(zip(blist,positions))])
+    prof.count('matrix_products',len(blist))
+
+    return s,M
+
+@prof.timed
+def Mplot(blist,llist,step=None,max_points=None,adaptive=False,output='lists',entries=None):
     '''calculate s-dependent matrix elements of given beam line with specified lenghts.
     @param blist: list of functions of ion optical elements (careful: elements with multiple input params: partial)
     @param llist: list of lenghts of ion optical elements
+    @param step, max_points, adaptive: sampling, see sample_points
+    @param output: string, lists: tuples of lists as below, array: (n,len(entries)) float array,
+                   structured: (n,) structured array with a field for each entry
+    @param entries: list of matrix elements for array and structured output, e.g. ['M12','M34'], default all of ENTRIES
     @return: 
         s: propagation
         first tuple: horizontal transport matrix elements
         second tuple: horizontal transport matrix elements
-        
+        (or s and array for array and structured output)
     '''
-    M11, M12, M21, M22, M33, M34, M43, M44 = ([] for i in range(8))
-    
+    if is_uncoupled_line(blist,llist):
+        s,M = Mblocks(blist,llist,step,max_points,adaptive)
+    else:
+        s,M = _Mstack_dense(blist,llist,step,max_points,adaptive)
+
+    if output == 'lists':
+        return (s,)+stack_to_lists(M)
+
+    return s,select_entries(M,entries,output)
+
+def Mplot_chunks(blist,llist,chunksize=10**6,step=None,max_points=None,adaptive=False,output='array',entries=None):
+    '''s-dependent matrix elements in chunks of fixed size, the whole profile is never held in memory
+    @param chunksize: int, samples per chunk (last chunk may be shorter)
+    @param ...: see Mplot, output array or structured
+    @yield: s, array of the chunk'''
+    step,counts,end = sample_counts(blist,llist,step,max_points,adaptive)
+    offsets = np.concatenate([[0],np.cumsum(llist)[:-1]])
+
+    if is_uncoupled_line(blist,llist):
+        B_pre = prefix_blocks([element_blocks(ele,length) for ele,length in zip(blist,llist)])
+        profile = lambda i,pos: mul_blocks(element_blocks(blist[i],pos),B_pre[i])
+    else:
+        # coupled elements: dense matrices
+        M_pre = prefix([ele(length) for ele,length in zip(blist,llist)])
+        profile = lambda i,pos: np.matmul(element_stack(blist[i],pos),M_pre[i])
+
+    s_pieces = []
+    pieces = []
+    pending = 0
+    for i in range(len(llist)):
+        for a in range(0,counts[i],chunksize):
+            # positions of this piece only
+            pos = element_positions(llist,step,counts,end,i,a,min(a+chunksize,counts[i]))
+            s_pieces.append(offsets[i]+pos)
+            pieces.append(select_entries(profile(i,pos),entries,output))
+            pending += len(pos)
+            prof.count('matrix_products')
+
+            while pending >= chunksize:
+                s = np.concatenate(s_pieces)
+                A = np.concatenate(pieces)
+                yield s[:chunksize],A[:chunksize]
+                s_pieces = [s[chunksize:]]
+                pieces = [A[chunksize:]]
+                pending -= chunksize
+
+    if pending:
+        yield np.concatenate(s_pieces),np.concatenate(pieces)
+
+# names of the matrix elements of uncoupled transport matrices
+ENTRIES = ['M11','M12','M21','M22','M33','M34','M43','M44']
+
+def select_entries(M,entries=None,output='array'):
+    '''matrix elements of a stack as one contiguous array
+    @param M: (n,4,4) array or (2,2,2,n) plane blocks
+    @param entries: list of names Mrc (row r, column c, 1 to 4), default ENTRIES
+    @param output: string, array: (n,len(entries)) float array, structured: (n,) array with a field for each entry
+    @return: array'''
+    if entries is None:
+        entries = ENTRIES
+    compact = np.shape(M)[-2:] != (4,4)
+    n = np.shape(M)[-1] if compact else len(M)
+
+    if output == 'array':
+        A = np.empty((n,len(entries)))
+        columns = [A[:,j] for j in range(len(entries))]
+    elif output == 'structured':
+        A = np.empty(n,dtype=[(name,float) for name in entries])
+        columns = [A[name] for name in entries]
+    else:
+        raise ValueError('unknown output: {}'.format(output))
+
+    for name,column in zip(entries,columns):
+        r,c = int(name[1])-1,int(name[2])-1
+        if not compact:
+            column[...] = M[:,r,c]
+        elif r//2 == c//2:
+            column[...] = M[r//2,r%2,c%2]
+        else:
+            column[...] = 0
+
+    return A
+
+def step_size(llist):
+    '''sampling step of s-dependent calculations, given by the max. number of decimals of the lengths
+    @param llist: list of lenghts of ion optical elements
+    @return: number of decimals, step'''
     dec = max([str(i)[::-1].find('.') for i in llist])
     step = 10**-dec
-    
-    M_static = [ele(length) for ele,length in zip(blist,llist)]
-    M_dyn = lambda x: [ele(x) for ele in blist]
-    # save static elements in list and multiply current l-dependent matrix with it
-    for i,l in enumerate(llist):
-        dist = np.arange(0,l,step)
-        for d in dist:
-            stat = M_static[:i]
-            dyn = [M_dyn(d)[i]]
-            stat.extend(dyn)
-            
-            M_temp = bl(stat)
-
-            M11.append(M_temp[0][0])
-            M12.append(M_temp[0][1])
-            M21.append(M_temp[1][0])
-            M22.append(M_temp[1][1])
-            
-            M33.append(M_temp[2][2])
-            M34.append(M_temp[2][3])
-            M43.append(M_temp[3][2])
-            M44.append(M_temp[3][3])
-            
-            
-            
-    s = np.arange(0,round(sum(llist),dec),step)
-        
-    return s,(M11,M12,M21,M22),(M33,M34,M43,M44)
+
+    return dec,step
+
+def sample_points(blist,llist,step=None,max_points=None,adaptive=False):
+    '''sampling positions of s-dependent calculations
+    @param blist: list of functions of ion optical elements
+    @param llist: list of lenghts of ion optical elements
+    @param step: float, sampling step, default: given by the decimals of the lengths, see step_size
+    @param max_points: int, max. number of samples, the step is increased if necessary
+    @param adaptive: True - drifts are sampled at their entrance only (their matrix elements are linear in s)
+                     and the end of the beam line is included
+    @return:
+        positions: list of arrays, sample positions from the entrance of each element
+        s: array, sample positions along the beam line'''
+    step,counts,end = sample_counts(blist,llist,step,max_points,adaptive)
+
+    positions = [element_positions(llist,step,counts,end,i,0,n) for i,n in enumerate(counts)]
+
+    offsets = np.concatenate([[0],np.cumsum(llist)[:-1]])
+    s = np.concatenate([offset+pos for offset,pos in zip(offsets,positions)]) if len(llist) else np.zeros(0)
+
+    return positions,s
+
+def sample_counts(blist,llist,step=None,max_points=None,adaptive=False):
+    '''number of samples of each element w/o the positions, see sample_points
+    @return:
+        steps: list of float, sampling step of each element (0 for elements sampled at their entrance only)
+        counts: list of int, number of samples of each element
+        end: bool, the end of the beam line is the last sample'''
+    if step is None:
+        dec,step = step_size(llist)
+
+    sampled = [not (adaptive and _is_drift(ele)) for ele in blist]
+
+    if max_points is not None:
+        # samples at step: sum of ceil(l/step) <= sum of l/step + 1 for sampled elements, 1 for each other element
+        n_fixed = sum(not smp for smp in sampled) + int(adaptive) + sum(sampled)
+        if max_points <= n_fixed:
+            raise ValueError('max_points too small, at least {} samples'.format(n_fixed+1))
+        l_sampled = sum(l for l,smp in zip(llist,sampled) if smp)
+        step = max(step,l_sampled/(max_points-n_fixed))
+
+    # same number of samples as np.arange(0,l,step)
+    counts = [int(np.ceil(l/step)) if smp else int(l > 0) for l,smp in zip(llist,sampled)]
+    steps = [step if smp else 0. for smp in sampled]
+    end = bool(adaptive and len(llist))
+    if end:
+        counts[-1] += 1
+
+    return steps,counts,end
+
+def element_positions(llist,steps,counts,end,i,a,b):
+    '''samples a to b of element i from its entrance, see sample_counts
+    @return: array'''
+    j = np.arange(a,b)
+    pos = steps[i]*j
+    if end and i == len(llist)-1:
+        pos[j == counts[i]-1] = llist[i]
+
+    return pos
+
+def _is_drift(ele):
+
+    return _function(ele) is drift
+
+def _function(ele):
+
+    return ele.func if isinstance(ele,partial) else ele
+
+def stack_to_lists(M):
+    '''convert stack of transport matrices to lists of matrix elements as returned by Mplot
+    @param M: (n,4,4) array or (2,2,2,n) plane blocks
+    @return: horizontal and vertical tuple of lists'''
+    if np.shape(M)[-2:] != (4,4):
+        return tuple(tuple(list(M[p,r,c]) for r,c in [(0,0),(0,1),(1,0),(1,1)]) for p in range(2))
+
+    M11, M12, M21, M22 = (list(M[:,r,c]) for r,c in [(0,0),(0,1),(1,0),(1,1)])
+    M33, M34, M43, M44 = (list(M[:,r,c]) for r,c in [(2,2),(2,3),(3,2),(3,3)])
+
+    return (M11,M12,M21,M22),(M33,M34,M43,M44)
 
 # optimize quadrupole triplet settings (strength)
 
+@prof.timed
 def opt_quad_mult(elements,lengths,image='P-to-P',S=True,prec=1e-3,iters=100,**kwargs):
     '''calculate quadrupole strengths for arbitrary sequence of beam line elements 
        for point-to-point or point-to-parallel imaging
        @param elements: list of functions, (drift, qdf, etc.)
-       @param lengths: list of floats, lengths (caution: analyzation steps ~ digits of lengths
+       @param lengths: list of floats, lengths
        @param image: string, P-to-P or P-to-Par
        @param S: bool, symmetric configuration
        @param prec: float, tolerance for termination
        @param iters: int, max. no. of iterations
        @param **kwargs: e.g. k_init: list, start values for k
-       @return: list, optimized values for k'''
+                             k_fix: dict, {position in k: fixed value}
+                             k_bounds: (min,max) of each free k, scalars or lists, default (0,inf)
+       @return: list, optimized values for k
+       see matching.match_global for many start values'''
 
-    no_qs = len([x for x in elements if (x == qdf or x == qf)])
+    opt,k_opt = _opt_quad(elements,lengths,image,S,prec,iters,**kwargs)
+
+    if opt.success == False:
+        print(opt.status)
+
+    return k_opt
+
+def _opt_quad(elements,lengths,image,S,prec,iters,**kwargs):
+    '''least-squares matching of the total transport matrix with analytic jacobian
+       @return: scipy OptimizeResult, array of all k (incl. fixed ones)'''
+
+    idx = k_index(elements,S)
+    no_k = len(set(j for j in idx if j is not None))
 
-    def residual(k):
+    k_fix = kwargs.get('k_fix',{})
+    free = [j for j in range(no_k) if j not in k_fix.keys()]
 
-        if 'k_fix' in kwargs.keys():
-            for pos in kwargs['k_fix'].keys():
-                k[pos] = kwargs['k_fix'][pos]
+    if image == 'P-to-P':
+        entries = [(0,1),(2,3)]
+    elif image == 'P-to-Par':
+        entries = [(0,0),(2,2)]
 
-        p_elements = eles_to_peles(elements,k,S)
-                
+    # elements w/o free strength do not change during optimization
+    line = compile_line(elements,lengths,S)
 
+    def full_k(k_free):
+        k = np.zeros(no_k)
+        for pos in k_fix.keys():
+            k[pos] = k_fix[pos]
+        k[free] = k_free
+        return k
 
-        if image == 'P-to-P':
-            res = (Mplot(p_elements,lengths)[1][1][-1])**2 + (Mplot(p_elements,lengths)[2][1][-1])**2
-        elif image == 'P-to-Par':
-            res = (Mplot(p_elements,lengths)[1][0][-1])**2 + (Mplot(p_elements,lengths)[2][0][-1])**2
+    def residual(k_free):
+        prof.count('residual_evaluations')
+        M = line(full_k(k_free))
+        return np.array([M[r][c] for r,c in entries])
 
+    def jacobian(k_free):
+        prof.count('jacobian_evaluations')
+        G = line.gradient(full_k(k_free))
+        jac = np.array([G[:,r,c] for r,c in entries])
 
-        return res
+        return jac[:,free]
 
     if 'k_init' in kwargs.keys():
-        k_init = kwargs['k_init']
+        k_init = np.asarray(kwargs['k_init'],dtype=float)
     else:
-        if S:
-            k_init = [2]*round(no_qs/2)
-        else:
-            k_init = [2]*no_qs
+        k_init = np.full(no_k,2.)
 
-    opt = sco.minimize(residual,k_init,tol=prec,options={'maxiter':iters})
-    
-    if opt.success == False:
-        print(opt.status)
+    k_bounds = kwargs.get('k_bounds',(0,np.inf))
 
+    opt = sco.least_squares(residual,k_init[free],jac=jacobian,bounds=k_bounds,
+                            xtol=prec**2,ftol=prec**2,gtol=prec**2,max_nfev=iters)
 
-    
-    return opt.x
+    return opt,full_k(opt.x)
 
-def plot_M_vs_s(blist,llist,**kwargs):
+# compiled beam line: fixed elements folded into constant matrices
+
+class CompiledLine:
+    '''total transport matrix of a beam line as function of the quadrupole strengths,
+    elements w/o free strength are multiplied once, each evaluation multiplies only
+    the quadrupoles onto the constant segments between them, using preallocated buffers
+    @param elements: list of functions, (drift, qdf, etc.) as for opt_quad_mult
+    @param lengths: list of floats, lengths
+    @param S: bool, symmetric configuration'''
+
+    def __init__(self,elements,lengths,S=True):
+        self.idx = k_index(elements,S)
+        self.no_k = len(set(j for j in self.idx if j is not None))
+
+        # M = C[m] Q[m-1] C[m-1] ... Q[0] C[0], C is None for identity
+        self.quads = []
+        self.const = []
+        C = None
+        for ele,l,j in zip(elements,lengths,self.idx):
+            if j is None:
+                C = ele(l) if C is None else np.matmul(ele(l),C)
+            else:
+                self.const.append(C)
+                self.quads.append((ele,l,j))
+                C = None
+        self.const.append(C)
+
+        self._compact = (all(ele in _compact for ele,l,j in self.quads)
+                         and all(C is None or is_uncoupled(C) for C in self.const))
+        if self._compact:
+            self._const_blocks = [None if C is None else to_blocks(C) for C in self.const]
+
+        self._buf = np.empty((2,4,4))
+        self._quad_buf = np.zeros((4,4))
+        self._batch_buf = None
+
+    def __call__(self,k):
+        '''total transport matrix
+        @param k: list of all quadrupole strengths
+        @return: (4,4) array'''
+        M,tmp = self._buf
+        M[...] = np.identity(4) if self.const[0] is None else self.const[0]
+        for (ele,l,j),C in zip(self.quads,self.const[1:]):
+            np.matmul(self._quad(ele,l,k[j]),M,out=tmp)
+            if C is None:
+                M,tmp = tmp,M
+            else:
+                np.matmul(C,tmp,out=M)
+        prof.count('matrix_products',len(self.quads)+sum(C is not None for C in self.const[1:]))
+
+        return M.copy()
+
+    def _quad(self,ele,l,k):
+        '''quadrupole matrix written into a buffer, element function for other elements or k <= 0'''
+        if (ele is not qf and ele is not qdf) or not k > 0:
+            return ele(l,k=k)
+
+        sk = math.sqrt(k)
+        c,s = math.cos(sk*l),math.sin(sk*l)
+        ch,sh = math.cosh(sk*l),math.sinh(sk*l)
+
+        Q = self._quad_buf
+        f,d = ((0,2) if ele is qf else (2,0))
+        Q[f,f],Q[f,f+1],Q[f+1,f],Q[f+1,f+1] = c,s/sk,-sk*s,c
+        Q[d,d],Q[d,d+1],Q[d+1,d],Q[d+1,d+1] = ch,sh/sk,sk*sh,ch
+        prof.count('element_matrices')
+
+        return Q
+
+    def batch(self,K):
+        '''total transport matrices for many settings
+        @param K: (N,no_k) array, all quadrupole strengths of each setting
+        @return: (N,4,4) array'''
+        K = np.atleast_2d(np.asarray(K,dtype=float))
+        N = K.shape[0]
+
+        if not self._compact:
+            Ms = [ele(l,k=K[:,j]) for ele,l,j in self.quads]
+            Ms = [M for pair in zip(self.const,Ms+[None]) for M in pair if M is not None]
+            if not Ms:
+                return np.broadcast_to(np.identity(4),(N,4,4)).copy()
+            return np.broadcast_to(bl_stack(Ms),(N,4,4)).copy()
+
+        if self._batch_buf is None or self._batch_buf.shape[-1] != N:
+            self._batch_buf = np.empty((2,2,2,2,N))
+        B,tmp = self._batch_buf
+
+        B[...] = to_blocks(np.identity(4))[...,None] if self._const_blocks[0] is None else self._const_blocks[0][...,None]
+        for (ele,l,j),C in zip(self.quads,self._const_blocks[1:]):
+            np.einsum('pik...,pkj...->pij...',ele(l,k=K[:,j],compact=True),B,out=tmp)
+            if C is None:
+                B,tmp = tmp,B
+            else:
+                np.einsum('pik,pkj...->pij...',C,tmp,out=B)
+        prof.count('matrix_products',len(self.quads)+sum(C is not None for C in self.const[1:]))
+
+        return from_blocks(B)
+
+    def gradient(self,k):
+        '''derivatives of the total transport matrix with respect to each k
+        @param k: list of all quadrupole strengths
+        @return: (no_k,4,4) array'''
+        Qs = [ele(l,k=k[j]) for ele,l,j in self.quads]
+        const = [np.identity(4) if C is None else C for C in self.const]
+
+        # transport matrices up to the entrance of each quadrupole and from its exit to the end
+        M_pre = [const[0]]
+        for Q,C in zip(Qs[:-1],const[1:-1]):
+            M_pre.append(np.matmul(C,np.matmul(Q,M_pre[-1])))
+        M_post = [const[-1]]
+        for Q,C in zip(Qs[:0:-1],const[-2:0:-1]):
+            M_post.insert(0,np.matmul(np.matmul(M_post[0],Q),C))
+        prof.count('matrix_products',4*len(Qs))
+
+        G = np.zeros((self.no_k,4,4))
+        for (ele,l,j),pre,post in zip(self.quads,M_pre,M_post):
+            G[j] += np.matmul(post,np.matmul(_dk[ele](l,k[j]),pre))
+
+        return G
+
+def compile_line(elements,lengths,S=True):
+    '''compile beam line for repeated evaluation with different quadrupole strengths, see CompiledLine
+    @return: CompiledLine, call with k vector, batch with (N,no_k) array'''
+    return CompiledLine(elements,lengths,S)
+
+def plot_M_vs_s(blist,llist,step=None,max_points=None,adaptive=False,**kwargs):
+    '''plot s-dependent matrix elements of given beam line, see Mplot and plot_M'''
+
+    return plot_M(*Mplot(blist,llist,step,max_points,adaptive),**kwargs)
+
+@prof.timed
+def plot_M(s,Mx,My,**kwargs):
+    '''plot s-dependent matrix elements as returned by Mplot
+    @param s: propagation
+    @param Mx: horizontal transport matrix elements
+    @param My: vertical transport matrix elements
+    @param **kwargs: figure keywords
+    @return axes: axes object'''
 
     if 'figsize' in kwargs.keys():
         fig, ax = plt.subplots(1,2, figsize=kwargs['figsize'])
@@ -298,11 +856,11 @@ def plot_M_vs_s(blist,llist,**kwargs):
         fig, ax = plt.subplots(1,2) 
 
 
-    ax[0].plot(Mplot(blist,llist)[0],Mplot(blist,llist)[1][0])
-    ax[0].plot(Mplot(blist,llist)[0],Mplot(blist,llist)[2][0])
+    ax[0].plot(s,Mx[0])
+    ax[0].plot(s,My[0])
 
-    ax[1].plot(Mplot(blist,llist)[0],Mplot(blist,llist)[1][1])
-    ax[1].plot(Mplot(blist,llist)[0],Mplot(blist,llist)[2][1])
+    ax[1].plot(s,Mx[1])
+    ax[1].plot(s,My[1])
 
     ax[0].legend(['M11','M33'])
     ax[1].legend(['M12','M34'])
@@ -312,22 +870,21 @@ def plot_M_vs_s(blist,llist,**kwargs):
 
     return ax
 
-def eles_to_peles(elements,k,S):
-    '''convert list of elements to list with partials and fixed ks, considers symmetry
+def k_index(elements,S):
+    '''position of each quadrupole strength in k, considers symmetry
        @param elements: list of functions (w/o partials)
-       @param k: list of quadrupole strengths t.b. assigned
-       @param S: bool, symmetry. length of k needs to be adapted
-       @return: list of functions, k assigned, w/ partials'''
+       @param S: bool, symmetry
+       @return: list, index in k for quadrupoles, None for other elements'''
 
     no_qs = len([x for x in elements if (x == qdf or x == qf)])
 
-    p_elements = []
+    idx = []
     j = 0
     q = 0
-    for i,x in enumerate(elements):
+    for x in elements:
         if x == qdf or x == qf:
 
-            p_elements.append(partial(x,k = k[j]))
+            idx.append(j)
 
             if S:
                 if q+1 > no_qs/2:
@@ -342,12 +899,28 @@ def eles_to_peles(elements,k,S):
             q+=1
 
         else:
-            p_elements.append(elements[i])  
+            idx.append(None)
 
-    return p_elements
+    return idx
+
+def eles_to_peles(elements,k,S):
+    '''convert list of elements to list with partials and fixed ks, considers symmetry
+       @param elements: list of functions (w/o partials)
+       @param k: list of quadrupole strengths t.b. assigned
+       @param S: bool, symmetry. length of k needs to be adapted
+       @return: list of functions, k assigned, w/ partials'''
 
+    p_elements = []
+    for x,j in zip(elements,k_index(elements,S)):
+        if j is not None:
+            p_elements.append(partial(x,k = k[j]))
+        else:
+            p_elements.append(x)
 
+    return p_elements
 
-    
-        
+# derivatives of quadrupoles with respect to k
+_dk = {qf: dqf, qdf: dqdf}
 
+# elements which build plane blocks directly
+_compact = {qf, qdf, drift, dipole}
@@ -1,11 +1,24 @@
+import glob
+import json
+import os
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib.ticker as ticker
+import matplotlib.colors as colors
+from ionoptics import profiling as prof
 
-def plot_phase_space(df,ele_w = False,**kwargs):
+@prof.timed
+def plot_phase_space(df,ele_w = False,mode = 'scatter',bins = 100,log = False,**kwargs):
     '''
     @param df: dataframe with 7 columns (turn, spatial coordinates, momentum space coordinates)
     @param ele_w: True - element-wise plotting of phase spaces
+    @param mode: 'scatter' - every particle, 'hist' - binned density with RMS ellipses (cost independent of particle number)
+    @param bins: number of bins per axis for mode 'hist'
+    @param log: True - logarithmic density scale for mode 'hist'
     @param **kwargs: figure keywords
     @return axes: axes object
     '''
@@ -40,92 +53,52 @@ def plot_phase_space(df,ele_w = False,**kwargs):
 
     plt.subplots_adjust(hspace=0.5,wspace=0.3)
 
-    eles = df['element'].unique()
-    eles = eles[1:] #drop beginning element
-    
-    
-    
-    df_xmax = df_start[df_start['x'] == df_start['x'].max()]
-    df_xmin = df_start[df_start['x'] == df_start['x'].min()]
-    df_xrms = df_start.groupby('s').agg({'x':'std'}).reset_index()
+    stats = beam_statistics(df)
 
-    df_ymax = df_start[df_start['y'] == df_start['y'].max()]
-    df_ymin = df_start[df_start['y'] == df_start['y'].min()]
-    df_yrms = df_start.groupby('s').agg({'y':'std'}).reset_index()
+    eles = stats.index[1:] #drop beginning element
     
-    for i,ele in enumerate(eles):
-        df_end_ele = df_end[df_end['element']==ele]
-
-        if ele_w==True:
-        
-            df_start.plot(x = 'x',
-                          y = 'xp', 
-                          kind = 'scatter',
-                          ax = axes[i][0],
-                          c = 'r'
-                         )
-
-            df_end_ele.plot(x = 'x',
-                        y = 'xp', 
-                        kind = 'scatter',
-                        ax = axes[i][0]
-                       )
-        
-            df_start.plot(x = 'y',
-                          y = 'yp', 
+    if mode == 'hist':
+        hists = phase_space_histograms(df,bins)
+    else:
+        groups = df_end.groupby('element',sort=False,observed=True)
+
+    def panel(ax_,ele,u,v):
+        '''phase space u-v of start distribution and of element ele'''
+        if mode == 'hist':
+            _plot_density(ax_,hists,ele,u,v,log)
+            _plot_rms_ellipse(ax_,stats.iloc[0],u,v,c = 'r')
+            _plot_rms_ellipse(ax_,stats.loc[ele],u,v,c = 'tab:blue')
+            ax_.set_xlabel(u)
+            ax_.set_ylabel(v)
+        else:
+            df_start.plot(x = u,
+                          y = v, 
                           kind = 'scatter',
-                          ax = axes[i][1],
+                          ax = ax_,
                           c = 'r'
                          )
 
-            df_end_ele.plot(x = 'y',
-                        y = 'yp', 
-                        kind = 'scatter',
-                        ax = axes[i][1]
-                       )
+            groups.get_group(ele).plot(x = u,
+                                       y = v, 
+                                       kind = 'scatter',
+                                       ax = ax_
+                                      )
 
+    for i,ele in enumerate(eles):
 
+        if ele_w==True:
+        
+            panel(axes[i][0],ele,'x','xp')
+            panel(axes[i][1],ele,'y','yp')
         
             axes[i][1].legend(['start','end'])
-            axes[i][0].text(0.1,0.9,ele + ' s = {:.2f}'.format(df_end_ele['s'].drop_duplicates().tolist()[0]),transform=axes[i][0].transAxes)
+            axes[i][0].text(0.1,0.9,ele + ' s = {:.2f}'.format(stats.loc[ele,'s']),transform=axes[i][0].transAxes)
         
-        df_xmax = df_xmax.append(df_end_ele[df_end_ele['x'] == df_end_ele['x'].max()])
-        df_xmin = df_xmin.append(df_end_ele[df_end_ele['x'] == df_end_ele['x'].min()])
-        df_xrms = df_xrms.append(df_end_ele.groupby('s').agg({'x':'std'}).reset_index())
-        df_xrms['-x'] = -df_xrms['x']
-
-        df_ymax = df_ymax.append(df_end_ele[df_end_ele['y'] == df_end_ele['y'].max()])
-        df_ymin = df_ymin.append(df_end_ele[df_end_ele['y'] == df_end_ele['y'].min()])
-        df_yrms = df_yrms.append(df_end_ele.groupby('s').agg({'y':'std'}).reset_index())
-        df_yrms['-y'] = -df_yrms['y']
 
     if ele_w==False:
 
-        df_start.plot(x = 'x',
-                      y = 'xp', 
-                      kind = 'scatter',
-                      ax = ax0,
-                      c = 'r'
-                      )
-
-        df_end_ele.plot(x = 'x',
-                        y = 'xp', 
-                        kind = 'scatter',
-                        ax = ax0
-                       )
-
-        df_start.plot(x = 'y',
-                      y = 'yp', 
-                      kind = 'scatter',
-                      ax = ax1,
-                      c = 'r'
-                     )
-
-        df_end_ele.plot(x = 'y',
-                        y = 'yp', 
-                        kind = 'scatter',
-                        ax = ax1
-                       )
+        panel(ax0,eles[-1],'x','xp')
+        panel(ax1,eles[-1],'y','yp')
 
         ax0.legend(['start','end'])
 
@@ -147,23 +120,21 @@ def plot_phase_space(df,ele_w = False,**kwargs):
         
         
         
-    df_xmax.plot(x = 's',
-                 y = 'x',
-                 ax = ax,
-                 marker = 'o',
-                 c = 'g'
-                )
-
-    df_xmin.plot(x = 's',
-                 y = 'x',
-                 ax = ax,
-                 marker = 'o',
-                 c = 'g'
-                )
-
-    x_fill=ax.fill_between(df_xrms['s'],
-                           df_xrms['x'],
-                           df_xrms['-x'],
+    x_max,=ax.plot(stats['s'],
+                   stats['x_max'],
+                   marker = 'o',
+                   c = 'g'
+                  )
+
+    ax.plot(stats['s'],
+            stats['x_min'],
+            marker = 'o',
+            c = 'g'
+           )
+
+    x_fill=ax.fill_between(stats['s'],
+                           stats['x_rms'],
+                           -stats['x_rms'],
                            linestyle = '--',
                            color = 'g',
                            alpha = 0.5
@@ -171,31 +142,28 @@ def plot_phase_space(df,ele_w = False,**kwargs):
 
 
     
-    df_ymax.plot(x = 's',
-                 y = 'y',
-                 ax = ax,
-                 marker = 'o',
-                 c = 'm'
-                )
-
-    df_ymin.plot(x = 's',
-                 y = 'y',
-                 ax = ax,
-                 marker = 'o',
-                 c = 'm'
-                )
-
-
-    y_fill=ax.fill_between(df_yrms['s'],
-                           df_yrms['y'],
-                           df_yrms['-y'],
+    y_max,=ax.plot(stats['s'],
+                   stats['y_max'],
+                   marker = 'o',
+                   c = 'm'
+                  )
+
+    ax.plot(stats['s'],
+            stats['y_min'],
+            marker = 'o',
+            c = 'm'
+           )
+
+
+    y_fill=ax.fill_between(stats['s'],
+                           stats['y_rms'],
+                           -stats['y_rms'],
                            linestyle = '--',
                            color = 'm',
                            alpha = 0.5
                           )
 
-    h,_ = ax.get_legend_handles_labels()
-    ax.legend([h[0],h[2],x_fill,y_fill],['x_max','y_max','x_RMS','y_RMS'])
+    ax.legend([x_max,y_max,x_fill,y_fill],['x_max','y_max','x_RMS','y_RMS'])
     
 
     ticks_ax_y = ticker.FuncFormatter(lambda y, pos: '{0:g}'.format(y/1e-3))
@@ -206,38 +174,427 @@ def plot_phase_space(df,ele_w = False,**kwargs):
 
     
     # print initial ellipse size
-    print('xmax @  start:', df_xmax[df_xmax['s']==0]['x'].iloc[0])
-    print('xrms @  start:', df_xrms[df_xrms['s']==0]['x'].iloc[0])
+    start = stats.iloc[0]
+    end = stats.iloc[-1]
+
+    print('xmax @  start:', start['x_max'])
+    print('xrms @  start:', start['x_rms'])
     print('\n')
 
-    print('xmax @  end:', df_xmax[df_xmax['s']==df_xmax['s'].max()]['x'].iloc[0])
-    print('xrms @  end:', df_xrms[df_xrms['s']==df_xrms['s'].max()]['x'].iloc[0])
+    print('xmax @  end:', end['x_max'])
+    print('xrms @  end:', end['x_rms'])
     print('\n')
 
-    print('ymax @  start:', df_ymax[df_ymax['s']==0]['y'].iloc[0])
-    print('yrms @  start:', df_yrms[df_yrms['s']==0]['y'].iloc[0])
+    print('ymax @  start:', start['y_max'])
+    print('yrms @  start:', start['y_rms'])
     print('\n')
 
-    print('ymax @  end:', df_ymax[df_ymax['s']==df_ymax['s'].max()]['y'].iloc[0])
-    print('yrms @  end:', df_yrms[df_yrms['s']==df_ymax['s'].max()]['y'].iloc[0])
+    print('ymax @  end:', end['y_max'])
+    print('yrms @  end:', end['y_rms'])
     print('\n')
 
-    print('particle loss/%:', df_end_ele[df_end_ele['x']==0].shape[0]/df_end_ele.shape[0]*100)
+    print('particle loss/%:', (1-end['transmission'])*100)
     
 
     return fig
 
-def txt_to_df(PATH_TO_DATA,FILENAME):
-  df_ele=pd.read_table(PATH_TO_DATA + FILENAME,
-                     sep='\s+',
+@prof.timed
+def beam_statistics(df):
+    '''
+    per-element beam statistics in one grouped pass
+    @param df: dataframe as returned by txt_to_df, or iterable of such dataframes (chunks, e.g. tracking.track_chunks)
+    @return stats: dataframe indexed by element (in order of appearance) with
+        s, n: position and number of particles
+        x_max, x_min, x_mean, x_rms, xp_mean, xp_rms (and y, yp): extrema, centroids and RMS sizes
+        eps_x, beta_x, alpha_x (and y): RMS emittance and Twiss parameters
+        transmission: fraction of particles not lost (lost particles are set to 0 by Bmad),
+        all but n and transmission of the surviving particles only
+    '''
+    if isinstance(df,pd.DataFrame):
+        df = [df]
+
+    acc = None
+    for chunk in df:
+        part = _moments(chunk)
+        acc = part if acc is None else _merge_moments(acc,part)
+
+    stats = pd.DataFrame(index=acc.index)
+    stats['s'] = acc['s']
+    stats['n'] = (acc['n']+acc['lost']).astype(int)
+
+    for x,xp in [('x','xp'),('y','yp')]:
+        var_x = acc['M_'+x+x]/(acc['n']-1)
+        var_xp = acc['M_'+xp+xp]/(acc['n']-1)
+
+        stats[x+'_max'] = acc[x+'_max']
+        stats[x+'_min'] = acc[x+'_min']
+        stats[x+'_mean'] = acc[x+'_mean']
+        stats[x+'_rms'] = np.sqrt(var_x)
+        stats[xp+'_mean'] = acc[xp+'_mean']
+        stats[xp+'_rms'] = np.sqrt(var_xp)
+
+        # central moments w/o bessel correction for emittance
+        xx = acc['M_'+x+x]/acc['n']
+        xpxp = acc['M_'+xp+xp]/acc['n']
+        xxp = acc['M_'+x+xp]/acc['n']
+        eps = np.sqrt(xx*xpxp-xxp**2)
+
+        stats['eps_'+x] = eps
+        stats['beta_'+x] = xx/eps
+        stats['alpha_'+x] = -xxp/eps
+
+    stats['transmission'] = acc['n']/stats['n']
+
+    return stats
+
+def _moments(df):
+
+    cols = ['x','xp','y','yp']
+    lost = _lost(df)
+
+    acc = df.groupby('element',sort=False,observed=True).agg(s=('s','first'))
+    acc['lost'] = pd.Series(lost,index=df.index).groupby(df['element'],sort=False,observed=True).sum()
+
+    # moments of the surviving particles
+    df = df[~lost]
+    g = df.groupby('element',sort=False,observed=True)
+    acc = acc.join(g.agg(n=('x','size'),x_max=('x','max'),x_min=('x','min'),y_max=('y','max'),y_min=('y','min')))
+    acc['n'] = acc['n'].fillna(0)
+
+    means = g[cols].mean()
+    d = df[cols].to_numpy() - means.loc[df['element']].to_numpy()
+    for col in cols:
+        acc[col+'_mean'] = means[col]
+
+    prods = pd.DataFrame({'M_xx':d[:,0]**2,'M_xpxp':d[:,1]**2,'M_xxp':d[:,0]*d[:,1],
+                          'M_yy':d[:,2]**2,'M_ypyp':d[:,3]**2,'M_yyp':d[:,2]*d[:,3]},index=df.index)
+    acc = acc.join(prods.groupby(df['element'],sort=False,observed=True).sum())
+    acc.index = acc.index.astype(str)
+
+    return acc
+
+def _lost(df):
+    '''lost particles: all coordinates set to 0 by Bmad'''
+
+    return (df[['x','xp','y','yp']] == 0).all(axis=1).to_numpy()
+
+def _merge_moments(a,b):
+    '''combine moments of two chunks (parallel algorithm of Chan et al.)'''
+
+    index = a.index.append(b.index.difference(a.index,sort=False))
+    a = a.reindex(index)
+    b = b.reindex(index)
+    # no surviving particles of an element in one of the chunks
+    only_a = b['n'].fillna(0) == 0
+    only_b = a['n'].fillna(0) == 0
+
+    acc = pd.DataFrame(index=index)
+    acc['s'] = a['s'].fillna(b['s'])
+    n_a = a['n'].fillna(0)
+    n_b = b['n'].fillna(0)
+    acc['n'] = n_a+n_b
+    acc['lost'] = a['lost'].fillna(0)+b['lost'].fillna(0)
+
+    for col in ['x','y']:
+        acc[col+'_max'] = np.fmax(a[col+'_max'],b[col+'_max'])
+        acc[col+'_min'] = np.fmin(a[col+'_min'],b[col+'_min'])
+
+    delta = {}
+    for col in ['x','xp','y','yp']:
+        delta[col] = (b[col+'_mean']-a[col+'_mean']).fillna(0)
+        acc[col+'_mean'] = a[col+'_mean'].fillna(0)+delta[col]*n_b/acc['n']
+        acc.loc[only_b,col+'_mean'] = b.loc[only_b,col+'_mean']
+        acc.loc[only_a,col+'_mean'] = a.loc[only_a,col+'_mean']
+
+    for i,j in [('x','x'),('xp','xp'),('x','xp'),('y','y'),('yp','yp'),('y','yp')]:
+        M = 'M_'+i+j
+        acc[M] = a[M].fillna(0)+b[M].fillna(0)+delta[i]*delta[j]*n_a*n_b/acc['n']
+
+    return acc
+
+@prof.timed
+def phase_space_histograms(df,bins=100):
+    '''
+    2D histograms of x-xp and y-yp for all elements in one vectorized pass, binned within the range of each element
+    @param df: dataframe as returned by txt_to_df
+    @param bins: number of bins per axis
+    @return hists: dict, {'x': (H, edges_x, edges_xp), 'y': (H, edges_y, edges_yp), 'elements': element names}
+        with H: (elements,bins,bins) array of counts, edges: (elements,bins+1) arrays
+    '''
+    codes,elements = pd.factorize(df['element'],sort=False)
+    n = len(elements)
+
+    # lost particles (set to 0 by Bmad) would dominate the density at the origin
+    alive = ~_lost(df)
+    df = df[alive]
+    codes = codes[alive]
+
+    hists = {'elements':pd.Index(elements.astype(str))}
+    for u,v in [('x','xp'),('y','yp')]:
+        idx = []
+        edges = []
+        for col in [u,v]:
+            vals = df[col].to_numpy()
+            lo = pd.Series(vals).groupby(codes).min().reindex(range(n),fill_value=0).to_numpy()
+            width = pd.Series(vals).groupby(codes).max().reindex(range(n),fill_value=0).to_numpy()-lo
+            width[width == 0] = 1
+
+            idx.append(np.clip(((vals-lo[codes])/width[codes]*bins).astype(np.int64),0,bins-1))
+            edges.append(lo[:,None]+width[:,None]*np.linspace(0,1,bins+1))
+
+        H = np.bincount((codes*bins+idx[0])*bins+idx[1],minlength=n*bins*bins).reshape(n,bins,bins)
+        hists[u] = (H,edges[0],edges[1])
+
+    return hists
+
+def _plot_density(ax,hists,ele,u,v,log):
+
+    j = hists['elements'].get_loc(ele)
+    H,edges_u,edges_v = hists[u]
+
+    H = np.ma.masked_equal(H[j].T,0)
+    norm = colors.LogNorm() if log else None
+
+    ax.pcolormesh(edges_u[j],edges_v[j],H,cmap='Blues',norm=norm)
+
+def _plot_rms_ellipse(ax,stat,u,v,**kwargs):
+    '''RMS ellipse from a row of beam_statistics'''
+
+    t = np.linspace(0,2*np.pi,100)
+    eps,beta,alpha = stat['eps_'+u],stat['beta_'+u],stat['alpha_'+u]
+
+    ax.plot(stat[u+'_mean']+np.sqrt(eps*beta)*np.cos(t),
+            stat[v+'_mean']-np.sqrt(eps/beta)*(alpha*np.cos(t)+np.sin(t)),
+            **kwargs)
+
+# columns of Bmad tracking output
+COLUMNS = ['turn','element','s','x','xp','y','yp']
+
+@prof.timed
+def txt_to_df(PATH_TO_DATA,FILENAME,cache=True,float32=False,columns=None,elements=None):
+    '''
+    load Bmad tracking output
+    @param PATH_TO_DATA: directory (incl. trailing separator)
+    @param FILENAME: name of tracking file
+    @param cache: True - keep binary copy FILENAME.npz next to the file, reused while size and mtime of the file are unchanged
+    @param float32: True - coordinates as float32
+    @param columns: list of columns to load, default all
+    @param elements: list of element names to keep, default all
+    @return df_ele: dataframe
+    '''
+    path = PATH_TO_DATA + FILENAME
+
+    data = None
+    if cache:
+        data = _read_cache(path,_cache_keys(columns,elements))
+    if data is None:
+        data = _parse(path)
+        if cache:
+            prof.count('cache_misses')
+            _write_cache(path,data)
+    else:
+        prof.count('cache_hits')
+
+    return _to_df(data,float32,columns,elements)
+
+def _parse(path):
+
+    df = pd.read_csv(path,
+                     sep=r'\s+',
+                     engine='c',
                      header=None,
-                     names=['turn','element','s','x','xp','y','yp'],
-                     usecols=[1,2,3,4,5,6,7]
+                     names=COLUMNS,
+                     usecols=[1,2,3,4,5,6,7],
+                     dtype={'turn':np.int32,'element':'category','s':np.float64,
+                            'x':np.float64,'xp':np.float64,'y':np.float64,'yp':np.float64}
                     )
 
-  return df_ele
+    data = {col:df[col].to_numpy() for col in COLUMNS if col != 'element'}
+    data['element_codes'] = df['element'].cat.codes.to_numpy()
+    data['element_names'] = np.asarray(df['element'].cat.categories,dtype=str)
 
+    return data
 
+def _stat(path):
 
-        
+    st = os.stat(path)
+
+    return np.array([st.st_size,st.st_mtime_ns])
+
+def _cache_keys(columns,elements):
+    '''members of the cache file needed by _to_df'''
+
+    keys = [col for col in (COLUMNS if columns is None else columns) if col != 'element']
+    if elements is not None or columns is None or 'element' in columns:
+        keys += ['element_codes','element_names']
+
+    return keys
+
+def _read_cache(path,keys):
+    '''needed members of a valid cache file, None if missing, outdated, truncated or foreign'''
+
+    try:
+        with np.load(path + '.npz') as f:
+            if not np.array_equal(f['_stat'],_stat(path)):
+                return None
+            data = {key:f[key] for key in keys}
+    except (OSError,EOFError,ValueError,KeyError,zipfile.BadZipFile):
+        return None
+
+    if len(set(len(v) for key,v in data.items() if key != 'element_names')) > 1:
+        return None
+
+    return data
+
+def _write_cache(path,data):
+
+    tmp = path + '.tmp.npz'
+    try:
+        np.savez(tmp,_stat=_stat(path),**data)
+        os.replace(tmp,path + '.npz')
+    except OSError as err:
+        warnings.warn('could not write cache of {}: {}'.format(path,err))
 
+def _to_df(data,float32,columns,elements):
+
+    if columns is None:
+        columns = COLUMNS
+
+    mask = slice(None)
+    codes = None
+    if elements is not None or 'element' in columns:
+        codes = data['element_codes']
+        names = data['element_names']
+    if elements is not None:
+        mask = np.isin(codes,np.flatnonzero(np.isin(names,elements)))
+
+    df_ele = pd.DataFrame()
+    for col in columns:
+        if col == 'element':
+            df_ele[col] = pd.Categorical.from_codes(codes[mask],categories=names)
+        elif col == 'turn':
+            df_ele[col] = data[col][mask]
+        else:
+            df_ele[col] = data[col][mask].astype(np.float32 if float32 else np.float64,copy=False)
+
+    return df_ele
+
+# many runs as one columnar dataset
+
+@prof.timed
+def load_runs(pattern,out=None,run_ids=None,processes=None):
+    '''
+    load many Bmad tracking files as one dataframe with a run column, files are parsed in parallel
+    @param pattern: glob of tracking files, e.g. 'data/run*/tracking_ele.txt'
+    @param out: directory of the dataset (one binary file per column and meta.json), reloaded memory-mapped
+                while no file is added, removed or modified, default: no dataset is written
+    @param run_ids: list of run identifiers in order of the sorted files, default: path relative to the common directory
+    @param processes: int, number of worker processes (None: all cores, 1: no pool)
+    @return:
+        df: dataframe with columns run and as txt_to_df
+        runs: dataframe of the runs (index run): path, rows, offset (first row in df), size, mtime_ns
+    '''
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError('no files match {}'.format(pattern))
+
+    if run_ids is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+        run_ids = [os.path.relpath(os.path.abspath(p),root) for p in paths]
+    run_ids = [str(r) for r in run_ids]
+
+    stats = [_stat(p) for p in paths]
+
+    if out is not None:
+        meta = _read_meta(out)
+        if meta is not None and meta['runs'] == [{'run':r,'path':os.path.abspath(p),'size':int(st[0]),'mtime_ns':int(st[1])}
+                                                  for r,p,st in zip(run_ids,paths,stats)]:
+            prof.count('cache_hits')
+            return _load_dataset(out,meta)
+        prof.count('cache_misses')
+
+    if processes == 1 or len(paths) == 1:
+        return _write_dataset(out,paths,run_ids,stats,map(_parse,paths))
+
+    with ProcessPoolExecutor(max_workers=processes) as ex:
+        return _write_dataset(out,paths,run_ids,stats,ex.map(_parse,paths))
+
+def _write_dataset(out,paths,run_ids,stats,parsed):
+    '''append columns run by run as the parsed files arrive, to raw column files for out'''
+
+    dtypes = {'run':np.int32,'element':np.int32,'turn':np.int32,
+              's':np.float64,'x':np.float64,'xp':np.float64,'y':np.float64,'yp':np.float64}
+
+    if out is not None:
+        os.makedirs(out,exist_ok=True)
+        files = {col:open(os.path.join(out,col+'.bin'),'wb') for col in dtypes.keys()}
+    else:
+        chunks = {col:[] for col in dtypes.keys()}
+
+    # union of element names of all runs
+    lookup = {}
+    rows = []
+    for i,data in enumerate(parsed):
+        remap = np.array([lookup.setdefault(name,len(lookup)) for name in data['element_names'].tolist()],dtype=np.int32)
+        n = len(data['turn'])
+        columns = {'run':np.full(n,i,dtype=np.int32),
+                   'element':remap[data['element_codes']] if n else np.zeros(0,dtype=np.int32)}
+        for col in COLUMNS:
+            if col != 'element':
+                columns[col] = np.asarray(data[col],dtype=dtypes[col])
+        rows.append(n)
+
+        for col,values in columns.items():
+            if out is not None:
+                files[col].write(values.tobytes())
+            else:
+                chunks[col].append(values)
+
+    meta = {'columns':{col:np.dtype(dt).str for col,dt in dtypes.items()},
+            'element_names':list(lookup.keys()),
+            'runs':[{'run':r,'path':os.path.abspath(p),'size':int(st[0]),'mtime_ns':int(st[1])}
+                    for r,p,st in zip(run_ids,paths,stats)],
+            'rows':rows}
+
+    if out is None:
+        return _dataset_to_df({col:np.concatenate(chunks[col]) for col in dtypes.keys()},meta)
+
+    for f in files.values():
+        f.close()
+    # meta.json marks a complete dataset
+    with open(os.path.join(out,'meta.json.tmp'),'w') as f:
+        json.dump(meta,f)
+    os.replace(os.path.join(out,'meta.json.tmp'),os.path.join(out,'meta.json'))
+
+    return _load_dataset(out,meta)
+
+def _read_meta(out):
+
+    try:
+        with open(os.path.join(out,'meta.json')) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+def _load_dataset(out,meta):
+
+    n = sum(meta['rows'])
+    columns = {col:np.memmap(os.path.join(out,col+'.bin'),dtype=dt,mode='r',shape=(n,)) if n else np.zeros(0,dtype=dt)
+               for col,dt in meta['columns'].items()}
+
+    return _dataset_to_df(columns,meta)
+
+def _dataset_to_df(columns,meta):
+
+    runs = pd.DataFrame(meta['runs']).set_index('run')
+    runs.insert(1,'rows',meta['rows'])
+    runs.insert(2,'offset',np.concatenate([[0],np.cumsum(meta['rows'])[:-1]]).astype(np.int64))
+
+    df = {'run':pd.Categorical.from_codes(columns['run'],categories=runs.index),
+          'turn':columns['turn'],
+          'element':pd.Categorical.from_codes(columns['element'],categories=meta['element_names']),
+          's':columns['s']}
+    for col in COLUMNS[3:]:
+        df[col] = columns[col]
+
+    return pd.DataFrame(df,copy=False),runs
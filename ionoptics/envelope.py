@@ -0,0 +1,62 @@
+import numpy as np
+from ionoptics import beamline as bl
+from ionoptics import profiling as prof
+
+
+# beam sigma matrix
+
+def sigma_twiss(beta_x,alpha_x,eps_x,beta_y,alpha_y,eps_y):
+    '''beam sigma matrix of an uncoupled beam
+    @param beta, alpha: Twiss parameters of each plane
+    @param eps: RMS emittance of each plane
+    @return: (4,4) sigma matrix'''
+
+    sigma = np.zeros((4,4))
+    for p,(beta,alpha,eps) in enumerate([(beta_x,alpha_x,eps_x),(beta_y,alpha_y,eps_y)]):
+        gamma = (1+alpha**2)/beta
+        sigma[2*p:2*p+2,2*p:2*p+2] = eps*np.array([[beta,-alpha],[-alpha,gamma]])
+
+    return sigma
+
+def propagate(M,sigma0):
+    '''transport of a beam sigma matrix, M sigma0 M^T
+    @param M: (4,4) transport matrix or (...,4,4) stack
+    @param sigma0: (4,4) initial sigma matrix
+    @return: sigma matrix for each transport matrix'''
+
+    return np.matmul(np.matmul(M,sigma0),np.swapaxes(M,-1,-2))
+
+# s-dependent envelope
+
+@prof.timed
+def envelope(blist,llist,sigma0=None,step=None,max_points=None,adaptive=False,**kwargs):
+    '''calculate beam envelope along given beam line
+    @param blist: list of functions of ion optical elements, as for Mplot
+    @param llist: list of lenghts of ion optical elements
+    @param sigma0: (4,4) initial beam sigma matrix
+    @param step, max_points, adaptive: sampling, see beamline.sample_points (adaptive: beam sizes are
+                                       not linear in drifts, only the values at the boundaries are exact)
+    @param **kwargs: instead of sigma0: beta_x,alpha_x,eps_x,beta_y,alpha_y,eps_y
+    @return:
+        s: propagation
+        dict of arrays along s: sigma (n,4,4), beam sizes sigma_x, sigma_xp, sigma_y, sigma_yp,
+        Twiss parameters beta_x, alpha_x, beta_y, alpha_y and emittances eps_x, eps_y'''
+
+    if sigma0 is None:
+        sigma0 = sigma_twiss(**kwargs)
+
+    s,M = bl.Mstack(blist,llist,step,max_points,adaptive)
+    sigma = propagate(M,sigma0)
+
+    env = {'sigma':sigma}
+    for p,(x,xp) in enumerate([('x','xp'),('y','yp')]):
+        block = sigma[:,2*p:2*p+2,2*p:2*p+2]
+        eps = np.sqrt(np.linalg.det(block))
+
+        env['sigma_'+x] = np.sqrt(block[:,0,0])
+        env['sigma_'+xp] = np.sqrt(block[:,1,1])
+        env['beta_'+x] = block[:,0,0]/eps
+        env['alpha_'+x] = -block[:,0,1]/eps
+        env['eps_'+x] = eps
+
+    return s,env
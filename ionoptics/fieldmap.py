@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from ionoptics import profiling as prof
+
+
+# field maps of magnets on a regular grid, e.g. COMSOL text export
+
+class FieldMap:
+    '''field components on a regular grid, interpolated multilinearly (trilinear for 3D maps)
+    @param axes: list of 1D arrays, grid coordinates in m (ascending)
+    @param field: (len(axes[0]),...,len(axes[-1]),n_comp) array, field components in T
+    @param names: list of component names, e.g. ['Bx','By','Bz']'''
+
+    def __init__(self,axes,field,names):
+        self.axes = [np.asarray(a,dtype=float) for a in axes]
+        self.field = field
+        self.names = list(names)
+        self.coords = ['x','y','z'][:len(self.axes)]
+
+    @classmethod
+    def load(cls,path,cache=True,scale=1.):
+        '''read COMSOL text export (comment lines start with %, columns: coordinates then field components)
+        @param path: text file
+        @param cache: True - keep path.npy (field, memory-mapped on reload) and path.json (axes, names)
+                      next to the file, reused while size and mtime of the file are unchanged
+        @param scale: float, coordinates in m per unit of the file, e.g. 1e-3 for mm
+        @return: FieldMap'''
+
+        if cache:
+            fm = _read_cache(path)
+            if fm is not None:
+                prof.count('cache_hits')
+                axes,field,names = fm
+                return cls([a*scale for a in axes],field,names)
+            prof.count('cache_misses')
+
+        axes,field,names = _parse(path)
+        if cache:
+            _write_cache(path,axes,field,names)
+
+        return cls([a*scale for a in axes],field,names)
+
+    def component(self,name):
+        return self.names.index(name)
+
+    def __call__(self,points,components=None):
+        '''interpolated field, nan outside the grid
+        @param points: (N,dim) array of coordinates, or (dim,) for a single point
+        @param components: list of component names, default all
+        @return: (N,n_comp) array'''
+
+        points = np.atleast_2d(np.asarray(points,dtype=float))
+        comp = slice(None) if components is None else [self.component(c) for c in components]
+
+        # cell index and weight along each axis
+        idx = []
+        weights = []
+        outside = np.zeros(len(points),dtype=bool)
+        for d,a in enumerate(self.axes):
+            p = points[:,d]
+            outside |= (p < a[0]) | (p > a[-1])
+            if len(a) == 1:
+                # single grid value, e.g. cut plane: no upper corner
+                idx.append(np.zeros(len(p),dtype=int))
+                weights.append(np.zeros(len(p)))
+                continue
+            i = np.clip(np.searchsorted(a,p,side='right')-1,0,len(a)-2)
+            idx.append(i)
+            weights.append((p-a[i])/(a[i+1]-a[i]))
+
+        # corners of the cell along axes with more than one grid value
+        cell = [d for d,a in enumerate(self.axes) if len(a) > 1]
+        result = 0.
+        for corner in range(2**len(cell)):
+            w = np.ones(len(points))
+            index = list(idx)
+            for bit,d in enumerate(cell):
+                upper = (corner >> bit) & 1
+                w = w*(weights[d] if upper else 1-weights[d])
+                index[d] = idx[d]+upper
+            result = result + w[:,None]*self.field[tuple(index)][:,comp]
+
+        result[outside] = np.nan
+
+        return result
+
+    # integrated quantities along the beam axis
+
+    def line(self,component,axis='z',offset=None,n=None):
+        '''field component along a line parallel to axis
+        @param component: string, name of field component
+        @param axis: string, beam axis x, y or z
+        @param offset: dict, transverse coordinates, e.g. {'x':1e-3}, default 0
+        @param n: int, number of points, default grid points of axis
+        @return: s, B'''
+
+        d = self.coords.index(axis)
+        s = self.axes[d] if n is None else np.linspace(self.axes[d][0],self.axes[d][-1],n)
+
+        points = np.zeros((len(s),len(self.axes)))
+        for c,value in (offset or {}).items():
+            points[:,self.coords.index(c)] = value
+        points[:,d] = s
+
+        return s,self(points,[component])[:,0]
+
+    def integral(self,component,axis='z',offset=None,n=None):
+        '''integrated field along the beam axis in T m, see line'''
+
+        s,B = self.line(component,axis,offset,n)
+
+        return np.trapezoid(np.nan_to_num(B),s)
+
+    def effective_length(self,component,axis='z',offset=None,n=None):
+        '''length of the hard-edge magnet with the same integrated field and peak field, see line'''
+
+        s,B = self.line(component,axis,offset,n)
+        B = np.nan_to_num(B)
+
+        return np.trapezoid(B,s)/B[np.argmax(np.abs(B))]
+
+    def bending_angle(self,brho,component='By',axis='z',offset=None,n=None):
+        '''bending angle and effective length of a dipole, e.g. for beamline.dipole(L,L_max=L_eff,alpha=alpha)
+        @param brho: float, magnetic rigidity in T m
+        @return: alpha in rad, L_eff in m'''
+
+        return self.integral(component,axis,offset,n)/brho,self.effective_length(component,axis,offset,n)
+
+    def equivalent_k(self,brho,component='By',axis='z',gradient='x',h=1e-4,n=None):
+        '''strength and effective length of a quadrupole from the integrated gradient dB/d(gradient) on axis,
+        e.g. for beamline.qf(L_eff,k)
+        @param brho: float, magnetic rigidity in T m
+        @param h: float, step of the central difference in m
+        @return: k in 1/m^2 (positive: focusing in the gradient plane), L_eff in m'''
+
+        s,B_p = self.line(component,axis,{gradient:h},n)
+        s,B_m = self.line(component,axis,{gradient:-h},n)
+        g = np.nan_to_num((B_p-B_m)/(2*h))
+
+        G = np.trapezoid(g,s)
+        L_eff = G/g[np.argmax(np.abs(g))]
+
+        return G/(L_eff*brho),L_eff
+
+def _parse(path):
+
+    header = []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('%'):
+                break
+            header.append(line[1:].strip())
+
+    dim = 3
+    for line in header:
+        match = re.match(r'Dimension:\s*(\d+)',line)
+        if match:
+            dim = int(match.group(1))
+
+    data = pd.read_csv(path,sep=r'\s+',comment='%',header=None,engine='c').to_numpy(dtype=float)
+
+    # last header line: column names separated by 2+ spaces
+    names = re.split(r'\s{2,}',header[-1]) if header else []
+    if len(names) != data.shape[1]:
+        names = ['B{}'.format(i) for i in range(data.shape[1]-dim)]
+    else:
+        names = [name.split(' (')[0].split('.')[-1] for name in names[dim:]]
+
+    axes = [np.unique(data[:,d]) for d in range(dim)]
+    shape = tuple(len(a) for a in axes)
+    if np.prod(shape) != len(data):
+        raise ValueError('{} is not a regular grid: {} points for axes of {}'.format(path,len(data),shape))
+
+    # sort rows into grid, first coordinate slowest
+    index = tuple(np.searchsorted(a,data[:,d]) for d,a in enumerate(axes))
+    field = np.full(shape+(data.shape[1]-dim,),np.nan)
+    field[index] = data[:,dim:]
+
+    return axes,field,names
+
+def _stat(path):
+
+    st = os.stat(path)
+
+    return [st.st_size,st.st_mtime_ns]
+
+def _read_cache(path):
+
+    try:
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        if meta['_stat'] != _stat(path):
+            return None
+        axes = [np.array(a,dtype=float) for a in meta['axes']]
+        names = list(meta['names'])
+        field = np.load(path + '.npy',mmap_mode='r')
+    except (OSError,ValueError,KeyError,TypeError):
+        return None
+
+    if field.shape != tuple(len(a) for a in axes)+(len(names),):
+        return None
+
+    return axes,field,names
+
+def _write_cache(path,axes,field,names):
+
+    try:
+        np.save(path + '.tmp.npy',field)
+        os.replace(path + '.tmp.npy',path + '.npy')
+        # json last: marks a complete cache
+        with open(path + '.tmp.json','w') as f:
+            json.dump({'_stat':_stat(path),'axes':[a.tolist() for a in axes],'names':names},f)
+        os.replace(path + '.tmp.json',path + '.json')
+    except OSError as err:
+        warnings.warn('could not write cache of {}: {}'.format(path,err))
@@ -1,4 +1,6 @@
+import bisect
 import numpy as np
+import pandas as pd
 from matplotlib import pyplot as plt
 from helpers import cusplot as cplt
 from helpers import numerics as num
@@ -8,7 +10,7 @@ from functools import partial
 
 def s_kick_sept(x_sept,x_add,x_init,kick,perm,init,l_kick,l_sept,sept_type='DC'):
     '''function that calculates the propagation distance in a kicker + septum beam line.
-    Calculated lengths correspond to the deflected arms.'''
+    Calculated lengths correspond to the deflected arms. All parameters broadcast as numpy arrays.'''
     # offset: inital + orbit in kicker
     x_init = x_init + l_kick*kick/2
     
@@ -21,10 +23,15 @@ def s_kick_sept(x_sept,x_add,x_init,kick,perm,init,l_kick,l_sept,sept_type='DC')
     
     s2 = (x_add-o_sept-d_k_sept)/np.sin(kick+perm+init)
     
-    if sept_type == 'OFS':
-        # dist from septum end to x_add separaion (Opposite Field Septum)
-        s2 = (x_add-2*o_sept-d_k_sept)/np.sin(kick+2*perm+init)
-        # 2*o_sept AND 2*perm because beam manipulation in two field regions
+    if isinstance(sept_type,str):
+        if sept_type == 'OFS':
+            # dist from septum end to x_add separaion (Opposite Field Septum)
+            s2 = (x_add-2*o_sept-d_k_sept)/np.sin(kick+2*perm+init)
+            # 2*o_sept AND 2*perm because beam manipulation in two field regions
+    else:
+        # array of septum types
+        s2_OFS = (x_add-2*o_sept-d_k_sept)/np.sin(kick+2*perm+init)
+        s2 = np.where(np.asarray(sept_type) == 'OFS',s2_OFS,s2)
      
     s = s1+s2+l_sept
     
@@ -44,7 +51,7 @@ def quad_defl(k,l,kick,l_kick,l1,l2):
 def plot_comb_kick_sept(x_sept,x_add,x_init,init,l_kick,l_sept,sept_type,start_kick,step_kick,list_perm,max_prop,**kwargs):
 
     s_kick_sept_fix = lambda perm,kick: s_kick_sept(x_sept,x_add,x_init,kick,perm,init,l_kick,l_sept,sept_type)
-    d = num.iterate(s_kick_sept_fix,list_perm,start_kick,step_kick,max_prop)
+    d = num.solve(s_kick_sept_fix,list_perm,start_kick,step_kick,max_prop,tol=kwargs.get('tol',1e-6))
 
     if 'figsize' in kwargs.keys():
         _,ax = plt.subplots(1,2,figsize=kwargs['figsize'])
@@ -56,7 +63,7 @@ def plot_comb_kick_sept(x_sept,x_add,x_init,init,l_kick,l_sept,sept_type,start_k
     ax[0].set_xlabel('perm_angle [rad]')
 
     last_ele = list(d.values())[-1]
-    ax[0].text(0.5,0.02, r'$\Theta_k = {}$ rad'.format(last_ele))
+    ax[0].text(0.5,0.02, r'$\Theta_k = {:.4g}$ rad'.format(last_ele))
 
     # add B-field information
     if 'brho' in kwargs.keys():
@@ -66,8 +73,12 @@ def plot_comb_kick_sept(x_sept,x_add,x_init,init,l_kick,l_sept,sept_type,start_k
         cplt.add_axis(ax[0],'x',calc_magn_sept,'B [T]')
         cplt.add_axis(ax[0],'y',calc_magn_kick,'B [T]')
 
-    fst_arm = [(kick,s_kick_sept_fix(perm,kick)[1]) for perm,kick in zip(list(d.keys()),list(d.values()))]
-    snd_arm = [(kick,s_kick_sept_fix(perm,kick)[2]) for perm,kick in zip(list(d.keys()),list(d.values()))]    
+    perms = np.array(list(d.keys()))
+    kicks = np.array(list(d.values()))
+    _,s1,s2 = s_kick_sept_fix(perms,kicks)
+
+    fst_arm = list(zip(kicks,s1))
+    snd_arm = list(zip(kicks,s2))
 
     ax[1].scatter(*zip(*fst_arm))
     ax[1].scatter(*zip(*snd_arm))
@@ -85,4 +96,106 @@ def calc_magn(ang,l,brho):
     '''function that calculates magnetic field'''    
     B = ang*brho/l
     
-    return round(B,3)
\ No newline at end of file
+    return np.round(B,3)
+
+
+
+# design space of kicker + septum
+
+def explore_kick_sept(x_sept,x_add,x_init,kick,perm,init,l_kick,l_sept,sept_type='DC',max_prop=None,brho=None,B_kick_max=None,B_sept_max=None,chunksize=10**6):
+    '''evaluate s_kick_sept on the full grid of all given parameter values and select feasible geometries
+    @param x_sept ... sept_type: scalars or 1D arrays (as for s_kick_sept), the grid is their outer product
+    @param max_prop: max. total propagation distance
+    @param brho: magnetic rigidity in Tm, adds kicker and septum fields (calc_magn)
+    @param B_kick_max, B_sept_max: field limits in T (need brho)
+    @param chunksize: grid points evaluated at once
+    @return:
+        feasible: dataframe of all feasible grid points with parameters, s, s1, s2 (and B_kick, B_sept)
+        pareto: subset of feasible on the Pareto front of total length vs. kicker and septum field (angle w/o brho)'''
+
+    params = {'x_sept':x_sept,'x_add':x_add,'x_init':x_init,'kick':kick,'perm':perm,'init':init,
+              'l_kick':l_kick,'l_sept':l_sept,'sept_type':sept_type}
+    params = {name:np.atleast_1d(value) for name,value in params.items()}
+    shape = tuple(len(value) for value in params.values())
+
+    feasible = []
+    for start in range(0,int(np.prod(shape)),chunksize):
+        idx = np.unravel_index(np.arange(start,min(start+chunksize,int(np.prod(shape)))),shape)
+        grid = {name:value[i] for (name,value),i in zip(params.items(),idx)}
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            s,s1,s2 = s_kick_sept(**grid)
+
+        ok = (s1 > 0) & (s2 > 0)
+        if max_prop is not None:
+            ok &= s <= max_prop
+
+        chunk = dict(grid,s=s,s1=s1,s2=s2)
+        if brho is not None:
+            chunk['B_kick'] = calc_magn(grid['kick'],grid['l_kick'],brho)
+            chunk['B_sept'] = calc_magn(grid['perm'],grid['l_sept'],brho)
+            if B_kick_max is not None:
+                ok &= np.abs(chunk['B_kick']) <= B_kick_max
+            if B_sept_max is not None:
+                ok &= np.abs(chunk['B_sept']) <= B_sept_max
+
+        feasible.append(pd.DataFrame({name:value[ok] for name,value in chunk.items()}))
+
+    feasible = pd.concat(feasible,ignore_index=True)
+
+    if brho is not None:
+        objectives = np.column_stack([feasible['s'],np.abs(feasible['B_kick']),np.abs(feasible['B_sept'])])
+    else:
+        objectives = np.column_stack([feasible['s'],np.abs(feasible['kick']),np.abs(feasible['perm'])])
+    pareto = feasible[pareto_front(objectives)]
+
+    return feasible,pareto
+
+def pareto_front(objectives):
+    '''non-dominated points of two or three objectives, all objectives are minimized
+    @param objectives: (n,2) or (n,3) array
+    @return: bool array, True for points on the Pareto front'''
+
+    objectives = np.asarray(objectives,dtype=float)
+    if objectives.shape[1] == 2:
+        objectives = np.column_stack([objectives,np.zeros(len(objectives))])
+
+    o1,o2,o3 = objectives.T
+
+    # of points with equal 2nd and 3rd objective only those with the smallest 1st one are candidates
+    order = np.lexsort((o1,o3,o2))
+    new_group = np.ones(len(order),dtype=bool)
+    new_group[1:] = (np.diff(o2[order]) != 0) | (np.diff(o3[order]) != 0)
+    group_min = o1[order][np.maximum.accumulate(np.where(new_group,np.arange(len(order)),0))]
+    candidates = order[o1[order] == group_min]
+
+    # sweep in lexicographic order, a point can only be dominated by earlier points;
+    # staircase of earlier points in the 2nd/3rd objective: 2nd ascending, 3rd descending
+    candidates = candidates[np.lexsort((o3[candidates],o2[candidates],o1[candidates]))]
+
+    stair_2 = []
+    stair_3 = []
+    front = np.zeros(len(objectives),dtype=bool)
+    previous = None
+    for i,point in zip(candidates.tolist(),objectives[candidates].tolist()):
+        if point == previous:
+            # identical points share their status
+            front[i] = on_front
+            continue
+        previous = point
+        _,p2,p3 = point
+
+        j = bisect.bisect_right(stair_2,p2)-1
+        on_front = not (j >= 0 and stair_3[j] <= p3)
+        if not on_front:
+            continue
+        front[i] = True
+
+        j = bisect.bisect_left(stair_2,p2)
+        k = j
+        while k < len(stair_3) and stair_3[k] >= p3:
+            k += 1
+        stair_2[j:k] = [p2]
+        stair_3[j:k] = [p3]
+
+    return front
@@ -0,0 +1,254 @@
+import numpy as np
+from collections import OrderedDict
+from functools import partial
+from ionoptics import beamline as bl
+from ionoptics import profiling as prof
+
+
+# bounded cache of transport matrices
+
+class LRUCache:
+    '''mapping with bounded size, evicts the least recently used entry
+    @param maxsize: int, max. number of entries'''
+
+    def __init__(self,maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self,key,func):
+        '''return cached value of key, computed with func() on a miss'''
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            prof.count('cache_misses')
+            value = func()
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        else:
+            self.hits += 1
+            prof.count('cache_hits')
+            self._data.move_to_end(key)
+
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+# shared by all lattices, e.g. drifts are reused between optimizer iterations
+matrix_cache = LRUCache()
+
+# pure functions of this package, their matrices depend on the arguments only
+_cacheable = {bl.qf, bl.qdf, bl.dqf, bl.dqdf, bl.drift, bl.dipole}
+
+def element_key(ele):
+    '''hashable description of an ion optical element: function and fixed parameters,
+    None for other functions (e.g. lambdas reading outside state), which are not cached
+    @param ele: function or partial of ion optical element'''
+
+    if isinstance(ele,partial):
+        func = element_key(ele.func)
+        if func is None:
+            return None
+        key = (func,
+               tuple(_hashable(a) for a in ele.args),
+               tuple(sorted((kw,_hashable(v)) for kw,v in ele.keywords.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    return ele if any(ele is func for func in _cacheable) else None
+
+def _matrix_key(ele,l):
+
+    key = element_key(ele)
+
+    return None if key is None else ('element',key,float(l))
+
+def _hashable(value):
+
+    if isinstance(value,(np.ndarray,list,tuple)):
+        return tuple(np.asarray(value,dtype=float).ravel())
+    if isinstance(value,(int,float,np.number)):
+        return float(value)
+
+    return value
+
+def _readonly(M):
+
+    M = np.asarray(M,dtype=float)
+    M.setflags(write=False)
+
+    return M
+
+# balanced product tree of element matrices
+
+class ProductTree:
+    '''balanced binary tree of transport matrices, each node holds the product of its leaves,
+    so a single element is replaced and any segment is multiplied in O(log n) products
+    @param matrices: list of (4,4) transport matrices starting with first element'''
+
+    def __init__(self,matrices):
+        self.n = len(matrices)
+        self.size = 1
+        while self.size < self.n:
+            self.size *= 2
+
+        self.nodes = np.tile(np.identity(4),(2*self.size,1,1))
+        self.nodes[self.size:self.size+self.n] = matrices
+        for p in range(self.size-1,0,-1):
+            self.nodes[p] = np.matmul(self.nodes[2*p+1],self.nodes[2*p])
+        prof.count('matrix_products',self.size-1)
+
+    def update(self,i,M):
+        '''replace matrix of i-th element'''
+        p = self.size+i
+        self.nodes[p] = M
+        p //= 2
+        while p:
+            self.nodes[p] = np.matmul(self.nodes[2*p+1],self.nodes[2*p])
+            prof.count('matrix_products')
+            p //= 2
+
+    def product(self,i,j):
+        '''transport matrix of elements i to j-1'''
+        l = self.size+i
+        r = self.size+j
+        M_l = np.identity(4)
+        M_r = np.identity(4)
+        while l < r:
+            if l & 1:
+                M_l = np.matmul(self.nodes[l],M_l)
+                prof.count('matrix_products')
+                l += 1
+            if r & 1:
+                r -= 1
+                M_r = np.matmul(M_r,self.nodes[r])
+                prof.count('matrix_products')
+            l //= 2
+            r //= 2
+
+        prof.count('matrix_products')
+        return np.matmul(M_r,M_l)
+
+    def total(self):
+        '''transport matrix of all elements'''
+        return self.nodes[1].copy()
+
+# beam line with cached matrices
+
+class Lattice:
+    '''beam line of ion optical elements with cached element matrices and a product tree for segments
+    @param elements: list of functions of ion optical elements (w/ partials), as for Mplot
+    @param lengths: list of lengths of ion optical elements
+    @param cache: LRUCache, default: cache shared by all lattices'''
+
+    def __init__(self,elements,lengths,cache=None):
+        self.elements = list(elements)
+        self.lengths = list(lengths)
+        self.cache = matrix_cache if cache is None else cache
+        self.keys = [_matrix_key(ele,l) for ele,l in zip(self.elements,self.lengths)]
+
+        self._tree = None
+        # s-dependent matrices of each element, valid up to the first changed element
+        self._blocks = []
+        self._positions = []
+
+    @classmethod
+    def from_k(cls,elements,lengths,k,S=True,cache=None):
+        '''lattice with quadrupole strengths assigned, see eles_to_peles'''
+        return cls(bl.eles_to_peles(elements,k,S),lengths,cache)
+
+    def __len__(self):
+        return len(self.elements)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = ProductTree([self.element_matrix(i) for i in range(len(self))])
+
+        return self._tree
+
+    def update(self,i,element=None,length=None):
+        '''replace element and/or length at position i, e.g. when tuning a single quadrupole
+        @param i: int, position in beam line
+        @param element: function of ion optical element (w/ partial)
+        @param length: float, length of element'''
+        if element is not None:
+            self.elements[i] = element
+        if length is not None:
+            self.lengths[i] = length
+        self.keys[i] = _matrix_key(self.elements[i],self.lengths[i])
+
+        if self._tree is not None:
+            self._tree.update(i,self.element_matrix(i))
+        # samples upstream of the change stay valid
+        del self._blocks[i:]
+
+    def element_matrix(self,i):
+        '''transport matrix of i-th element'''
+        ele,l = self.elements[i],self.lengths[i]
+        if self.keys[i] is None:
+            return _readonly(ele(l))
+
+        return self.cache.get(self.keys[i],lambda: _readonly(ele(l)))
+
+    def segment_matrix(self,i,j):
+        '''transport matrix of elements i to j-1 (identity for i == j)'''
+        return self.tree.product(i,j)
+
+    def total_matrix(self):
+        '''transport matrix of the whole beam line'''
+        return self.tree.total()
+
+    def element_profile(self,i,positions):
+        '''transport matrices within i-th element at the given positions from its entrance
+        (not in the shared cache, their size grows with the resolution: profile keeps them per lattice)'''
+        return _readonly(bl.element_stack(self.elements[i],positions))
+
+    @prof.timed
+    def profile(self,step=None,max_points=None,adaptive=False):
+        '''s-dependent transport matrices, see Mstack
+        @param step, max_points, adaptive: sampling, see beamline.sample_points
+        @return: s, (n,4,4) array'''
+        positions,s = bl.sample_points(self.elements,self.lengths,step,max_points,adaptive)
+
+        # samples stay valid up to the first element with changed positions
+        valid = 0
+        for old,new in zip(self._positions,positions):
+            if valid >= len(self._blocks) or not np.array_equal(old,new):
+                break
+            valid += 1
+        del self._blocks[valid:]
+        self._positions = positions
+
+        # only elements downstream of the last change are recomputed
+        M_pre = self.segment_matrix(0,len(self._blocks))
+        prof.count('matrix_products',2*(len(self)-len(self._blocks)))
+        for i in range(len(self._blocks),len(self)):
+            self._blocks.append(np.matmul(self.element_profile(i,positions[i]),M_pre))
+            M_pre = np.matmul(self.element_matrix(i),M_pre)
+
+        M = np.concatenate(self._blocks)
+
+        return s,M
+
+    def Mplot(self,step=None,max_points=None,adaptive=False):
+        '''s-dependent matrix elements in the format of Mplot'''
+        s,M = self.profile(step,max_points,adaptive)
+
+        return (s,)+bl.stack_to_lists(M)
+
+    def plot(self,step=None,max_points=None,adaptive=False,**kwargs):
+        '''plot s-dependent matrix elements, see plot_M_vs_s'''
+        return bl.plot_M(*self.Mplot(step,max_points,adaptive),**kwargs)
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from scipy.stats import qmc
+from ionoptics import beamline as bl
+from ionoptics import profiling as prof
+
+
+# start values of quadrupole strengths
+
+def start_points(bounds,n,method='sobol',seed=None):
+    '''space-filling start values within the given bounds
+    @param bounds: list of (min,max) for each free k
+    @param n: int, number of start values (rounded up to a power of 2 for sobol)
+    @param method: string, sobol, lhs (latin hypercube) or random
+    @param seed: int, seed of random generator
+    @return: (n,len(bounds)) array'''
+
+    lo,hi = np.asarray(bounds,dtype=float).T
+
+    if method == 'sobol':
+        sample = qmc.Sobol(len(bounds),seed=seed).random_base2(int(np.ceil(np.log2(n))))
+    elif method == 'lhs':
+        sample = qmc.LatinHypercube(len(bounds),seed=seed).random(n)
+    elif method == 'random':
+        sample = np.random.default_rng(seed).random((n,len(bounds)))
+    else:
+        raise ValueError('unknown sampling method: {}'.format(method))
+
+    return qmc.scale(sample,lo,hi)
+
+# global matching
+
+@prof.timed
+def match_global(elements,lengths,image='P-to-P',S=True,bounds=(0.,10.),n_starts=64,method='sobol',seed=None,
+                 prec=1e-3,iters=100,tol=1e-6,dedup=1e-4,rank='residual',processes=None,**kwargs):
+    '''match quadrupole strengths from many start values, see opt_quad_mult
+       @param elements: list of functions, (drift, qdf, etc.) (must be picklable for processes > 1)
+       @param lengths: list of floats, lengths
+       @param image: string, P-to-P or P-to-Par
+       @param S: bool, symmetric configuration
+       @param bounds: (min,max) for all or list of (min,max) for each free k, range of start values and of the solutions
+       @param n_starts: int, number of start values
+       @param method: string, sampling of start values, see start_points
+       @param seed: int, seed of start values
+       @param prec: float, tolerance for termination of each local optimization
+       @param iters: int, max. no. of iterations of each local optimization
+       @param tol: float, max. residual of a converged solution
+       @param dedup: float, relative distance of k below which solutions are merged
+       @param rank: string, order of solutions: residual, max_k (weakest quadrupoles) or beam_size (smallest max. |M12|, |M34|)
+       @param processes: int, number of worker processes (None: all cores, 1: no pool)
+       @param **kwargs: e.g. k_fix: dict, {position in k: fixed value}
+       @return: dataframe, one row per distinct solution, best first, columns
+            k_0...k_n: all k (incl. fixed ones)
+            residual: squared sum of the imaging matrix elements
+            converged: residual <= tol
+            success, status, message, nfev: result of the best local optimization of this solution
+            starts: number of starts which ended in this solution
+            max_k: max. quadrupole strength
+            beam_size: max. |M12|, |M34| along the beam line'''
+
+    idx = bl.k_index(elements,S)
+    no_k = len(set(j for j in idx if j is not None))
+
+    k_fix = kwargs.pop('k_fix',{})
+    free = [j for j in range(no_k) if j not in k_fix.keys()]
+
+    if np.ndim(bounds) == 1:
+        bounds = [bounds]*len(free)
+    lo,hi = np.asarray(bounds,dtype=float).T
+
+    # start values strictly inside bounds, as required by least_squares
+    starts = start_points(bounds,n_starts,method,seed)
+    starts = np.clip(starts,lo+1e-9*(hi-lo),hi-1e-9*(hi-lo))
+    k_init = np.zeros((len(starts),no_k))
+    for pos in k_fix.keys():
+        k_init[:,pos] = k_fix[pos]
+    k_init[:,free] = starts
+
+    solve = partial(_solve,elements,lengths,image,S,prec,iters,k_fix,(lo,hi))
+
+    if processes == 1:
+        results = [solve(k) for k in k_init]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as ex:
+            results = list(ex.map(solve,k_init,chunksize=max(len(k_init)//32,1)))
+
+    df = pd.DataFrame(results)
+    df = _deduplicate(df,no_k,dedup)
+
+    df['converged'] = df['residual'] <= tol
+    k = df[['k_{}'.format(j) for j in range(no_k)]].to_numpy()
+    df['max_k'] = np.abs(k).max(axis=1) if no_k else 0.
+    df['beam_size'] = [beam_size(elements,lengths,k_j,S) for k_j in k]
+
+    if rank not in ['residual','max_k','beam_size']:
+        raise ValueError('unknown ranking: {}'.format(rank))
+    df = df.sort_values(['converged',rank,'residual'],ascending=[False,True,True],kind='stable')
+
+    return df.reset_index(drop=True)
+
+def _solve(elements,lengths,image,S,prec,iters,k_fix,k_bounds,k_init):
+    '''local optimization from one start value, worker of match_global'''
+
+    opt,k = bl._opt_quad(elements,lengths,image,S,prec,iters,k_init=k_init,k_fix=k_fix,k_bounds=k_bounds)
+
+    result = {'k_{}'.format(j):k_j for j,k_j in enumerate(k)}
+    result.update({'residual':2*opt.cost,'success':opt.success,'status':opt.status,
+                   'message':opt.message,'nfev':opt.nfev})
+
+    return result
+
+def _deduplicate(df,no_k,dedup):
+    '''merge solutions with equal k (within relative distance dedup), keep the one with min. residual'''
+
+    df = df.sort_values('residual',kind='stable').reset_index(drop=True)
+    k = df[['k_{}'.format(j) for j in range(no_k)]].to_numpy()
+
+    representatives = []
+    label = np.empty(len(df),dtype=int)
+    for i,k_i in enumerate(k):
+        for r,j in enumerate(representatives):
+            if np.all(np.abs(k_i-k[j]) <= dedup*(1+np.abs(k[j]))):
+                label[i] = r
+                break
+        else:
+            label[i] = len(representatives)
+            representatives.append(i)
+
+    distinct = df.iloc[representatives].copy()
+    distinct['starts'] = np.bincount(label)
+
+    return distinct
+
+def beam_size(elements,lengths,k,S=True):
+    '''beam size proxy of a quadrupole setting: max. |M12|, |M34| along the beam line
+    @param elements: list of functions (w/o partials)
+    @param lengths: list of floats, lengths
+    @param k: list of quadrupole strengths
+    @param S: bool, symmetry
+    @return: float'''
+
+    s,M = bl.Mstack(bl.eles_to_peles(elements,k,S),lengths)
+
+    return max(np.max(np.abs(M[:,0,1])),np.max(np.abs(M[:,2,3])))
+
+# persistent store of matching results
+
+def cache_dir():
+    '''directory of persistent caches: $IONOPTICS_CACHE_DIR, default ~/.cache/ionoptics'''
+    return os.environ.get('IONOPTICS_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.cache','ionoptics'))
+
+def element_description(ele,strict=True):
+    '''canonical string of an ion optical element: module and qualified name of the function
+    and fixed parameters of partials
+    @param strict: bool, raise ValueError for functions w/o unique name, i.e. lambdas, local functions
+                   and functions of __main__ (e.g. all notebook lambdas are __main__.<lambda>)'''
+
+    if isinstance(ele,partial):
+        args = [repr(_canonical(a)) for a in ele.args]
+        args += ['{}={!r}'.format(kw,_canonical(v)) for kw,v in sorted(ele.keywords.items())]
+        return '{}({})'.format(element_description(ele.func,strict),','.join(args))
+
+    module = getattr(ele,'__module__',None)
+    name = getattr(ele,'__qualname__',repr(ele))
+    if strict and (module in [None,'__main__'] or '<' in name):
+        raise ValueError('{}.{} has no canonical description, define it in a module or pass a key'.format(module,name))
+
+    return '{}.{}'.format(module,name)
+
+def _canonical(value):
+
+    if isinstance(value,(np.ndarray,list,tuple)):
+        return [_canonical(v) for v in np.asarray(value,dtype=float).ravel().tolist()]
+    if isinstance(value,(int,float,np.number)):
+        return float(value)
+
+    return value
+
+def problem_key(elements,image,S,prec,iters,key=None,**kwargs):
+    '''hash of a matching problem w/o the lengths: elements, imaging and optimizer options
+    @param key: string, identifies user-defined elements (lambdas, notebook functions), required for those'''
+
+    k_fix = {str(pos):float(v) for pos,v in kwargs.get('k_fix',{}).items()}
+    description = {'elements':[element_description(ele,strict=key is None) for ele in elements],
+                   'image':image,'S':bool(S),'prec':float(prec),'iters':int(iters),
+                   'k_fix':k_fix,'k_bounds':_canonical(kwargs.get('k_bounds',(0,np.inf)))}
+    if key is not None:
+        description['key'] = str(key)
+
+    return hashlib.sha256(json.dumps(description,sort_keys=True).encode()).hexdigest()
+
+class ResultStore:
+    '''sqlite store of optimized quadrupole strengths, keyed by problem and lengths
+    @param path: database file, default cache_dir()/matching.sqlite
+    @param max_entries: int, least recently used results are evicted beyond this size'''
+
+    def __init__(self,path=None,max_entries=10000):
+        if path is None:
+            path = os.path.join(cache_dir(),'matching.sqlite')
+        self.path = path
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS results
+                           (problem TEXT, lengths TEXT, k TEXT, accessed REAL, PRIMARY KEY (problem,lengths))''')
+            con.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    @contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.path,timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def get(self,problem,lengths):
+        '''cached k of the problem with exactly these lengths, None if not solved yet'''
+        key = json.dumps(_canonical(lengths))
+        with self._connect() as con:
+            row = con.execute('SELECT k FROM results WHERE problem = ? AND lengths = ?',(problem,key)).fetchone()
+            if row is None:
+                prof.count('cache_misses')
+                return None
+            con.execute('UPDATE results SET accessed = ? WHERE problem = ? AND lengths = ?',(time.time(),problem,key))
+        prof.count('cache_hits')
+
+        return np.array(json.loads(row[0]))
+
+    def nearest(self,problem,lengths):
+        '''k of the problem solved for the closest lengths (euclidean distance), None if not solved yet
+        @return: k, distance'''
+        lengths = np.asarray(lengths,dtype=float)
+        with self._connect() as con:
+            rows = con.execute('SELECT lengths, k FROM results WHERE problem = ?',(problem,)).fetchall()
+
+        best = None,np.inf
+        for key,k in rows:
+            d = np.linalg.norm(np.asarray(json.loads(key))-lengths)
+            if d < best[1]:
+                best = np.array(json.loads(k)),d
+
+        return best
+
+    def put(self,problem,lengths,k):
+        '''store k of the problem with these lengths, evict least recently used results'''
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?)',
+                        (problem,json.dumps(_canonical(lengths)),json.dumps(_canonical(k)),time.time()))
+            con.execute('''DELETE FROM results WHERE rowid IN
+                           (SELECT rowid FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)''',(self.max_entries,))
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute('DELETE FROM results')
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+def opt_quad_cached(elements,lengths,image='P-to-P',S=True,prec=1e-3,iters=100,store=None,key=None,**kwargs):
+    '''opt_quad_mult with persistent results: returns stored k for an already solved problem,
+    starts from the k of the closest solved lengths otherwise (unless k_init is given),
+    only successful optimizations are stored
+       @param store: ResultStore, default store in cache_dir()
+       @param key: string, identifies user-defined elements, see problem_key
+       @param ...: see opt_quad_mult
+       @return: array, optimized values for k
+                dict, result: cached (bool), success, status, message, nfev of the optimization
+                (status None, nfev 0 for cached results)'''
+
+    if store is None:
+        store = ResultStore()
+
+    problem = problem_key(elements,image,S,prec,iters,key,**kwargs)
+
+    k = store.get(problem,lengths)
+    if k is not None:
+        return k,{'cached':True,'success':True,'status':None,'message':'stored result','nfev':0}
+
+    if 'k_init' not in kwargs.keys():
+        k_near,_ = store.nearest(problem,lengths)
+        if k_near is not None:
+            kwargs['k_init'] = k_near
+
+    opt,k = bl._opt_quad(elements,lengths,image,S,prec,iters,**kwargs)
+
+    if opt.success:
+        store.put(problem,lengths,k)
+
+    return k,{'cached':False,'success':opt.success,'status':opt.status,'message':opt.message,'nfev':opt.nfev}
@@ -0,0 +1,117 @@
+import json
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+# opt-in instrumentation of beam line computations
+# hooks in the library only check _active, so they cost one comparison while no profile is running
+
+_active = None
+
+class Profile:
+    '''counters and stage timings collected while the profile is active, e.g.
+
+        with ionoptics.profile() as p:
+            bl.opt_quad_mult(elements,lengths)
+        print(p.report())
+
+    counters: element_matrices (constructed transport matrices, stacks count each matrix),
+    matrix_products (matmul calls, a product of stacks counts once), residual_evaluations,
+    jacobian_evaluations, cache_hits, cache_misses (matrix cache of lattices and file cache of txt_to_df).
+    work done in worker processes (scan_quads, track with processes > 1) is not counted.'''
+
+    def __init__(self):
+        self.counts = {}
+        # stage: [calls, total time in s]
+        self.stages = {}
+        self._previous = None
+        self._start = None
+        self.wall_time = 0.
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        global _active
+        self.wall_time += time.perf_counter()-self._start
+        _active = self._previous
+        self._previous = None
+
+    def count(self,name,n=1):
+        self.counts[name] = self.counts.get(name,0)+n
+
+    def add_time(self,name,t):
+        entry = self.stages.setdefault(name,[0,0.])
+        entry[0] += 1
+        entry[1] += t
+
+    def to_dict(self):
+        '''machine-readable summary'''
+        return {'wall_time':self.wall_time,
+                'counts':dict(self.counts),
+                'stages':{name:{'calls':calls,'time':t} for name,(calls,t) in self.stages.items()}}
+
+    def dump(self,path):
+        '''write summary as json'''
+        with open(path,'w') as f:
+            json.dump(self.to_dict(),f,indent=1)
+
+    def report(self):
+        '''summary as text table, stages sorted by time (times include nested stages)'''
+        lines = ['{:<28}{:>8}{:>12}{:>12}'.format('stage','calls','total [s]','mean [s]')]
+        for name,(calls,t) in sorted(self.stages.items(),key=lambda item: -item[1][1]):
+            lines.append('{:<28}{:>8}{:>12.4g}{:>12.4g}'.format(name,calls,t,t/calls))
+        lines.append('')
+        lines.append('{:<28}{:>8}'.format('counter','value'))
+        for name,value in sorted(self.counts.items()):
+            lines.append('{:<28}{:>8}'.format(name,value))
+        lines.append('')
+        lines.append('wall time: {:.4g} s'.format(self.wall_time))
+
+        return '\n'.join(lines)
+
+def profile():
+    '''start instrumentation, use as context manager, see Profile'''
+    return Profile()
+
+# hooks
+
+def count(name,n=1):
+    '''increase counter of the active profile'''
+    if _active is not None:
+        _active.count(name,n)
+
+@contextmanager
+def stage(name):
+    '''time enclosed block as stage of the active profile'''
+    if _active is None:
+        yield
+        return
+    profile_ = _active
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile_.add_time(name,time.perf_counter()-start)
+
+def timed(func):
+    '''decorator, time each call of func as stage named after func'''
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+        if _active is None:
+            return func(*args,**kwargs)
+        profile_ = _active
+        start = time.perf_counter()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            profile_.add_time(name,time.perf_counter()-start)
+
+    return wrapper
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+from ionoptics import beamline as bl
+from ionoptics import profiling as prof
+from ionoptics.bmad import COLUMNS
+from ionoptics.tracking import inside
+
+
+# one-turn map of a periodic beam line
+
+def one_turn(elements,lengths):
+    '''transport matrix of one turn
+    @param elements: list of functions of ion optical elements (w/ partials)
+    @param lengths: list of lengths of ion optical elements
+    @return: (4,4) array'''
+
+    return bl.bl_stack([ele(l) for ele,l in zip(elements,lengths)])
+
+def _plane_eigen(M):
+    '''phase advance per turn of each plane from the eigenvalues of its block, nan if unstable'''
+
+    mu = []
+    for p in range(2):
+        block = M[2*p:2*p+2,2*p:2*p+2]
+        w = np.linalg.eigvals(block)
+        # stable: complex conjugate pair on the unit circle
+        if np.all(np.isclose(np.abs(w),1)) and not np.all(np.isreal(w)):
+            mu_p = np.abs(np.angle(w[0]))
+            # sign of sin(mu) is the sign of M12
+            if block[0,1] < 0:
+                mu_p = 2*np.pi-mu_p
+            mu.append(mu_p)
+        else:
+            mu.append(np.nan)
+
+    return mu
+
+def stable(M):
+    '''stability of the periodic motion in each plane
+    @param M: (4,4) one-turn matrix
+    @return: bool horizontal, bool vertical'''
+
+    mu_x,mu_y = _plane_eigen(M)
+
+    return bool(np.isfinite(mu_x)),bool(np.isfinite(mu_y))
+
+def tunes(M):
+    '''fractional tunes
+    @param M: (4,4) one-turn matrix
+    @return: Q_x, Q_y (nan for an unstable plane)'''
+
+    mu_x,mu_y = _plane_eigen(M)
+
+    return mu_x/(2*np.pi),mu_y/(2*np.pi)
+
+def periodic_twiss(M):
+    '''periodic Twiss parameters at the start of the turn, M = I cos(mu) + J sin(mu)
+    @param M: (4,4) one-turn matrix
+    @return: dict, beta_x, alpha_x, gamma_x, mu_x, Q_x and the same for y (nan for an unstable plane)'''
+
+    twiss = {}
+    for p,(x,mu) in enumerate(zip(['x','y'],_plane_eigen(M))):
+        M11,M12,M21,M22 = M[2*p,2*p],M[2*p,2*p+1],M[2*p+1,2*p],M[2*p+1,2*p+1]
+        sin_mu = np.sin(mu)
+
+        twiss['beta_'+x] = M12/sin_mu
+        twiss['alpha_'+x] = (M11-M22)/(2*sin_mu)
+        twiss['gamma_'+x] = -M21/sin_mu
+        twiss['mu_'+x] = mu
+        twiss['Q_'+x] = mu/(2*np.pi)
+
+    return twiss
+
+# multi-turn tracking
+
+def turn_matrices(M,turns):
+    '''powers of the one-turn matrix: equally spaced turns by doubling, others each from the previous one
+    by repeated squaring of the gap
+    @param M: (4,4) one-turn matrix
+    @param turns: sorted array of turn numbers
+    @return: (len(turns),4,4) array'''
+
+    turns = np.asarray(turns,dtype=np.int64)
+    gaps = np.diff(turns)
+    P = np.linalg.matrix_power(M,int(turns[0])) if len(turns) else np.identity(4)
+
+    if len(gaps) == 0 or np.all(gaps == gaps[0]):
+        G = np.linalg.matrix_power(M,int(gaps[0])) if len(gaps) else M
+        return np.matmul(_powers(G,len(turns)),P)
+
+    powers = np.empty((len(turns),4,4))
+    powers[0] = P
+    for i,gap in enumerate(gaps):
+        P = np.matmul(np.linalg.matrix_power(M,int(gap)),P)
+        powers[i+1] = P
+    prof.count('matrix_products',len(turns))
+
+    return powers
+
+def _powers(M,n):
+    '''M**0 to M**(n-1), the second half of each filled range from the first one: P[m:2m] = M**m P[:m]'''
+
+    P = np.empty((n,4,4))
+    P[:1] = np.identity(4)
+    m = 1
+    while m < n:
+        c = min(m,n-m)
+        np.matmul(M,P[:c],out=P[m:m+c])
+        M = np.matmul(M,M)
+        m += c
+    prof.count('matrix_products',n)
+
+    return P
+
+def track_turns_chunks(particles,elements,lengths,turns,aperture=None,name='END',chunksize=10**4):
+    '''track particles over many turns chunk by chunk of sampled turns, memory is bounded by chunksize, see track_turns
+    @param chunksize: int, sampled turns per chunk
+    @yield: dataframe of each chunk'''
+
+    if np.ndim(turns) == 0:
+        turns = np.arange(int(turns)+1,dtype=np.int64)
+    else:
+        turns = np.union1d(0,np.asarray(turns,dtype=np.int64))
+
+    M = one_turn(elements,lengths)
+    names = ['BEGINNING',name]
+    n = len(particles)
+    alive = np.ones(n,dtype=bool)
+
+    for a in range(0,len(turns),chunksize):
+        t = turns[a:a+chunksize]
+        coords = np.matmul(particles,turn_matrices(M,t).transpose(0,2,1))
+
+        if aperture is not None:
+            # lost from the first sampled turn outside on
+            ok = inside(coords.reshape(-1,4),aperture).reshape(len(t),n)
+            ok[0] &= alive
+            ok = np.logical_and.accumulate(ok,axis=0)
+            coords[~ok] = 0
+            alive = ok[-1]
+
+        element = pd.Categorical.from_codes(np.repeat(np.minimum(t,1),n),categories=names)
+        df = pd.DataFrame({'turn':np.repeat(t,n),
+                           'element':element,
+                           's':np.repeat(np.where(t > 0,sum(lengths),0.),n)})
+        for j,col in enumerate(COLUMNS[3:]):
+            df[col] = coords[:,:,j].ravel()
+
+        yield df
+
+@prof.timed
+def track_turns(particles,elements,lengths,turns,aperture=None,name='END',chunksize=10**4):
+    '''track particles over many turns with powers of the one-turn matrix
+    @param particles: (n,4) array, x, xp, y, yp at the start of turn 0
+    @param elements: list of functions of ion optical elements (w/ partials)
+    @param lengths: list of lengths of ion optical elements
+    @param turns: int, number of turns (all turns are returned), or array of sampled turn numbers (turn 0 is added)
+    @param aperture: tuple (shape, a_x, a_y), see tracking.inside, checked at the sampled turns only
+    @param name: element name of the rows at the end of a turn
+    @param chunksize: int, sampled turns computed at once, see track_turns_chunks
+    @return: dataframe with columns as bmad.txt_to_df, turn 0 is the start distribution (element BEGINNING),
+             lost particles are set to 0 from the first sampled turn outside the aperture on'''
+
+    return pd.concat(track_turns_chunks(particles,elements,lengths,turns,aperture,name,chunksize),ignore_index=True)
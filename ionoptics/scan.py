@@ -0,0 +1,78 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from ionoptics import beamline as bl
+from ionoptics import profiling as prof
+
+
+# parameter spaces of quadrupole strengths
+
+def k_grid(*axes):
+    '''all combinations of the given quadrupole strengths
+    @param *axes: arrays, values of each free k
+    @return: (N,len(axes)) array'''
+
+    return np.stack(np.meshgrid(*axes,indexing='ij'),axis=-1).reshape(-1,len(axes))
+
+def k_random(bounds,n,seed=None):
+    '''uniformly distributed quadrupole strengths
+    @param bounds: list of (min,max) for each free k
+    @param n: int, number of settings
+    @param seed: int, seed of random generator
+    @return: (n,len(bounds)) array'''
+
+    lo,hi = np.asarray(bounds,dtype=float).T
+    rng = np.random.default_rng(seed)
+
+    return rng.uniform(lo,hi,size=(n,len(bounds)))
+
+# scan of quadrupole settings
+
+@prof.timed
+def scan_quads(elements,lengths,K,S=True,image='P-to-P',chunksize=100000,processes=None,**kwargs):
+    '''calculate total transport matrices of a beam line for many quadrupole settings at once
+       @param elements: list of functions, (drift, qdf, etc.) as for opt_quad_mult (must be picklable for processes > 1)
+       @param lengths: list of floats, lengths
+       @param K: (N,no_k) array, free quadrupole strengths (k vector of opt_quad_mult w/o the positions in k_fix)
+       @param S: bool, symmetric configuration
+       @param image: string, P-to-P or P-to-Par, imaging residual
+       @param chunksize: int, settings evaluated at once
+       @param processes: int, number of worker processes (None: all cores, 1: no pool)
+       @param **kwargs: e.g. k_fix: dict, {position in k: fixed value}
+       @return: dict of arrays
+            k: (N,no_k) complete k vectors
+            M: (N,4,4) total transport matrices
+            res: (N,) imaging residual, squared sum as in opt_quad_mult
+            z1x,z2x,z1y,z2y: (N,) principal planes'''
+
+    idx = bl.k_index(elements,S)
+    no_k = len(set(j for j in idx if j is not None))
+
+    k_fix = kwargs.get('k_fix',{})
+    free = [j for j in range(no_k) if j not in k_fix.keys()]
+
+    K = np.atleast_2d(np.asarray(K,dtype=float))
+    k = np.empty((K.shape[0],no_k))
+    for pos in k_fix.keys():
+        k[:,pos] = k_fix[pos]
+    k[:,free] = K
+
+    chunks = [k[i:i+chunksize] for i in range(0,k.shape[0],chunksize)]
+    line = bl.compile_line(elements,lengths,S)
+
+    if processes == 1 or len(chunks) == 1:
+        M = [line.batch(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as ex:
+            M = list(ex.map(line.batch,chunks))
+
+    M = np.concatenate(M)
+
+    if image == 'P-to-P':
+        res = M[:,0,1]**2 + M[:,2,3]**2
+    elif image == 'P-to-Par':
+        res = M[:,0,0]**2 + M[:,2,2]**2
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        (z1x,z2x),(z1y,z2y) = bl.zplanes(M)
+
+    return {'k':k,'M':M,'res':res,'z1x':z1x,'z2x':z2x,'z1y':z1y,'z2y':z2y}
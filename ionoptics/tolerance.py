@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from ionoptics import beamline as bl
+from ionoptics import envelope as env
+from ionoptics import profiling as prof
+
+
+# Monte Carlo study of magnet errors
+
+# realisations per random stream, fixed so that results do not depend on chunksize
+BLOCK = 1024
+
+@prof.timed
+def tolerance_study(elements,lengths,n=10**5,sigma_k=1e-3,sigma_l=0.,sigma_edge=0.,sigma0=None,seed=None,
+                    chunksize=10**5,processes=None):
+    '''transport matrices of a beam line with random errors of the element parameters
+       @param elements: list of functions of ion optical elements (w/ partials), e.g. eles_to_peles(elements,k_opt,S)
+                        (must be picklable for processes > 1)
+       @param lengths: list of lengths of ion optical elements
+       @param n: int, number of error realisations
+       @param sigma_k: float, RMS relative error of the quadrupole strengths (partials of qf, qdf with keyword k)
+       @param sigma_l: float, RMS error of all lengths in m
+       @param sigma_edge: float, RMS error of the dipole face angles beta_s, beta_e in rad (partials of dipole with keywords)
+       @param sigma0: (4,4) initial beam sigma matrix for the beam size growth, default beta = 1 m, alpha = 0, eps = 1 m rad
+       @param seed: int, seed of the random errors, results do not depend on chunksize and processes
+       @param chunksize: int, realisations evaluated at once
+       @param processes: int, number of worker processes (None: all cores, 1: no pool)
+       @return: dataframe, one row per realisation
+            M11...M44: transport matrix elements
+            shift_x, shift_y: shift of the image plane, -M12/M22 and -M34/M44
+            growth_x, growth_y: final beam size relative to the line w/o errors'''
+
+    if sigma0 is None:
+        sigma0 = env.sigma_twiss(1,0,1,1,0,1)
+
+    M_nom = bl.bl_stack([ele(l) for ele,l in zip(elements,lengths)])
+    size_nom = np.sqrt(np.diagonal(env.propagate(M_nom,sigma0))[[0,2]])
+
+    # one seed per block of realisations, chunks may span several blocks or parts of them
+    seeds = np.random.SeedSequence(seed).spawn(-(-n//BLOCK))
+    starts = list(range(0,n,chunksize))
+    stops = [min(a+chunksize,n) for a in starts]
+
+    chunk = partial(_tolerance_chunk,elements,lengths,sigma_k,sigma_l,sigma_edge,sigma0,size_nom,n,seeds)
+
+    if processes == 1 or len(starts) == 1:
+        results = [chunk(a,b) for a,b in zip(starts,stops)]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as ex:
+            results = list(ex.map(chunk,starts,stops))
+
+    return pd.concat(results,ignore_index=True)
+
+def _tolerance_chunk(elements,lengths,sigma_k,sigma_l,sigma_edge,sigma0,size_nom,n,seeds,a,b):
+    '''error realisations a to b (of n), worker of tolerance_study'''
+
+    m = b-a
+    normal = partial(_normal,[np.random.default_rng(seeds[j]) for j in range(a//BLOCK,-(-b//BLOCK))],n,a,b)
+
+    eles = []
+    Ls = []
+    for ele,l in zip(elements,lengths):
+        Ls.append(l + sigma_l*normal() if sigma_l else l)
+        eles.append(_element_errors(ele,sigma_k,sigma_edge,normal))
+
+    # errors of the strengths, lengths and faces do not couple the planes
+    if bl.is_uncoupled_line(elements,lengths):
+        B = bl.bl_blocks([bl.element_blocks(ele,L) for ele,L in zip(eles,Ls)])
+        M = bl.from_blocks(np.broadcast_to(B,(2,2,2,m)))
+    else:
+        # coupled elements: dense matrices
+        M = np.broadcast_to(bl.bl_stack([bl.element_stack(ele,L) for ele,L in zip(eles,Ls)]),(m,4,4))
+
+    sigma = env.propagate(M,sigma0)
+
+    df = pd.DataFrame({'M{}{}'.format(r+1,c+1):M[:,r,c] for r,c in [(0,0),(0,1),(1,0),(1,1),(2,2),(2,3),(3,2),(3,3)]})
+    with np.errstate(divide='ignore'):
+        df['shift_x'] = -M[:,0,1]/M[:,1,1]
+        df['shift_y'] = -M[:,2,3]/M[:,3,3]
+    df['growth_x'] = np.sqrt(sigma[:,0,0])/size_nom[0]
+    df['growth_y'] = np.sqrt(sigma[:,2,2])/size_nom[1]
+
+    return df
+
+def _normal(rngs,n,a,b):
+    '''standard normal values of realisations a to b: each block draws all of its values from its own stream'''
+
+    first = a//BLOCK*BLOCK
+    values = np.concatenate([rng.standard_normal(min(BLOCK,n-first-j*BLOCK)) for j,rng in enumerate(rngs)])
+
+    return values[a-first:b-first]
+
+def _element_errors(ele,sigma_k,sigma_edge,normal):
+    '''element with random parameter errors (arrays of values drawn by normal())'''
+
+    if not isinstance(ele,partial) or ele.args:
+        return ele
+
+    kwargs = dict(ele.keywords)
+    if ele.func in [bl.qf,bl.qdf] and 'k' in kwargs.keys() and sigma_k:
+        kwargs['k'] = kwargs['k']*(1 + sigma_k*normal())
+    if ele.func == bl.dipole and sigma_edge:
+        for face in ['beta_s','beta_e']:
+            kwargs[face] = kwargs.get(face,0) + sigma_edge*normal()
+
+    return partial(ele.func,**kwargs)
+
+def summary(df,quantiles=(0.05,0.5,0.95)):
+    '''RMS and quantiles of the results of tolerance_study
+    @return: dataframe, one row per result column'''
+
+    stats = df.quantile(list(quantiles)).T
+    stats.columns = ['q{:g}'.format(100*q) for q in quantiles]
+    stats.insert(0,'rms',np.sqrt((df**2).mean()))
+    stats.insert(0,'mean',df.mean())
+
+    return stats
@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from ionoptics import profiling as prof
+from ionoptics.bmad import COLUMNS
+
+
+def element_names(elements):
+    '''default element names: function name and position in beam line, e.g. DRIFT_0
+    @param elements: list of functions of ion optical elements (w/ partials)
+    @return: list of strings'''
+
+    names = []
+    for i,ele in enumerate(elements):
+        func = ele.func if isinstance(ele,partial) else ele
+        names.append('{}_{}'.format(getattr(func,'__name__','element').upper(),i))
+
+    return names
+
+def inside(coords,aperture):
+    '''check particles against an aperture
+    @param coords: (n,4) array, x, xp, y, yp
+    @param aperture: tuple (shape, a_x, a_y), shape 'rect' or 'ellipse', half axes in m
+    @return: bool array, True for particles within aperture'''
+
+    shape,a_x,a_y = aperture
+
+    if shape == 'rect':
+        return (np.abs(coords[:,0]) <= a_x) & (np.abs(coords[:,2]) <= a_y)
+    elif shape == 'ellipse':
+        return (coords[:,0]/a_x)**2 + (coords[:,2]/a_y)**2 <= 1
+    else:
+        raise ValueError('unknown aperture shape: {}'.format(shape))
+
+# tracking
+
+@prof.timed
+def track_matrices(particles,matrices,apertures=None):
+    '''track particles through transport matrices, lost particles are set to 0 (as in Bmad output)
+    @param particles: (n,4) array, x, xp, y, yp
+    @param matrices: list of (4,4) transport matrices starting with first element
+    @param apertures: dict, {element position: aperture}, see inside, checked at element exit
+    @return: (len(matrices)+1,n,4) array, coordinates at start and at each element exit'''
+
+    if apertures is None:
+        apertures = {}
+
+    coords = np.empty((len(matrices)+1,)+np.shape(particles))
+    coords[0] = particles
+    alive = np.ones(len(particles),dtype=bool)
+
+    for i,M in enumerate(matrices):
+        np.matmul(coords[i],M.T,out=coords[i+1])
+        if i in apertures.keys():
+            alive &= inside(coords[i+1],apertures[i])
+            coords[i+1][~alive] = 0
+
+    return coords
+
+def track_chunks(particles,elements,lengths,apertures=None,names=None,chunksize=10**6,processes=1):
+    '''track particles through beam line chunk by chunk, memory is bounded by chunksize
+    @param particles: (N,4) array, x, xp, y, yp
+    @param elements: list of functions of ion optical elements (w/ partials)
+    @param lengths: list of lengths of ion optical elements
+    @param apertures: dict, {element position: aperture}, see inside
+    @param names: list of element names, default: element_names
+    @param chunksize: int, particles tracked at once
+    @param processes: int, number of worker processes (None: all cores)
+    @yield: dataframe of each chunk, columns as bmad.txt_to_df (turn 0: start, turn 1: element exits)'''
+
+    if names is None:
+        names = element_names(elements)
+
+    matrices = [ele(l) for ele,l in zip(elements,lengths)]
+    track = partial(track_matrices,matrices=matrices,apertures=apertures)
+    to_df = partial(_coords_to_df,names=['BEGINNING']+list(names),s=np.cumsum([0]+list(lengths)))
+
+    chunks = (particles[i:i+chunksize] for i in range(0,len(particles),chunksize))
+
+    if processes == 1:
+        for chunk in chunks:
+            yield to_df(track(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as ex:
+            # keep only one chunk per worker in flight
+            window = processes or os.cpu_count()
+            futures = []
+            for chunk in chunks:
+                futures.append(ex.submit(track,chunk))
+                if len(futures) >= window:
+                    yield to_df(futures.pop(0).result())
+            for future in futures:
+                yield to_df(future.result())
+
+@prof.timed
+def track(particles,elements,lengths,apertures=None,names=None,chunksize=10**6,processes=1):
+    '''track particles through beam line, see track_chunks
+    @return: dataframe with columns as bmad.txt_to_df, element by element (independent of chunksize)'''
+
+    chunks = list(track_chunks(particles,elements,lengths,apertures,names,chunksize,processes))
+    df = pd.concat(chunks,ignore_index=True)
+    if len(chunks) > 1:
+        # chunks are element-major each: stable sort by element position restores the order of one chunk
+        n_ele = len(elements)+1
+        position = np.concatenate([np.repeat(np.arange(n_ele),len(chunk)//n_ele) for chunk in chunks])
+        df = df.take(np.argsort(position,kind='stable')).reset_index(drop=True)
+
+    return df
+
+def _coords_to_df(coords,names,s):
+
+    n_ele,n = coords.shape[:2]
+
+    # names may repeat, e.g. drifts D1 at several positions: categories in order of appearance
+    codes,categories = pd.factorize(pd.Index(names))
+    element = pd.Categorical.from_codes(np.repeat(codes,n),categories=categories)
+    df = pd.DataFrame({'turn':np.repeat(np.minimum(np.arange(n_ele),1),n),
+                       'element':element,
+                       's':np.repeat(s,n)})
+    for j,col in enumerate(COLUMNS[3:]):
+        df[col] = coords[:,:,j].ravel()
+
+    return df
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from ionoptics import beamline as bl
+
+
+def central_difference(func,k,h=1e-6):
+    return (func(k+h)-func(k-h))/(2*h)
+
+@pytest.mark.parametrize('ele,dele',[(bl.qf,bl.dqf),(bl.qdf,bl.dqdf)])
+@pytest.mark.parametrize('L,k',[(0.2,0.5),(0.3,4.),(1.,12.)])
+def test_dk_finite_difference(ele,dele,L,k):
+    fd = central_difference(lambda k_: ele(L,k_),k)
+    np.testing.assert_allclose(dele(L,k),fd,rtol=1e-6,atol=1e-8)
+
+@pytest.mark.parametrize('ele,dele',[(bl.qf,bl.dqf),(bl.qdf,bl.dqdf)])
+def test_dk_arrays(ele,dele):
+    k = np.array([0.5,4.,12.])
+    D = dele(0.3,k)
+    for i,k_i in enumerate(k):
+        np.testing.assert_allclose(D[i],dele(0.3,k_i))
+
+def line():
+    elements = [bl.drift,bl.qf,bl.drift,bl.qdf,bl.drift,bl.qf,bl.drift]
+    lengths = [1.,0.3,0.25,0.3,0.4,0.3,1.2]
+    return elements,lengths
+
+@pytest.mark.parametrize('S',[True,False])
+def test_compiled_line(S):
+    elements,lengths = line()
+    cl = bl.compile_line(elements,lengths,S)
+    k = np.linspace(2.,5.,cl.no_k)
+
+    M = bl.bl_stack([ele(l) for ele,l in zip(bl.eles_to_peles(elements,k,S),lengths)])
+    np.testing.assert_allclose(cl(k),M,rtol=1e-12,atol=1e-12)
+    np.testing.assert_allclose(cl.batch([k,k])[1],M,rtol=1e-12,atol=1e-12)
+
+@pytest.mark.parametrize('S',[True,False])
+def test_compiled_line_gradient(S):
+    elements,lengths = line()
+    cl = bl.compile_line(elements,lengths,S)
+    k = np.linspace(2.,5.,cl.no_k)
+
+    G = cl.gradient(k)
+    for j in range(cl.no_k):
+        e = np.zeros(cl.no_k)
+        e[j] = 1
+        fd = central_difference(lambda h: cl(k+h*e),0.)
+        np.testing.assert_allclose(G[j],fd,rtol=1e-6,atol=1e-7)
+
+def rotation(L,angle=0.1):
+    '''coupled element: rotation about the beam axis, independent of L'''
+    c,s = np.cos(angle),np.sin(angle)
+    R = np.identity(4)
+    R[0,0] = R[1,1] = R[2,2] = R[3,3] = c
+    R[0,2] = R[1,3] = s
+    R[2,0] = R[3,1] = -s
+    return np.broadcast_to(R,np.shape(L)+(4,4)).copy()
+
+def test_coupled_line_dense_path():
+    from functools import partial
+    elements = [bl.drift,partial(bl.qf,k=2.),rotation,bl.drift]
+    lengths = [0.5,0.3,0.,0.5]
+
+    assert not bl.is_uncoupled_line(elements,lengths)
+    s,M = bl.Mstack(elements,lengths)
+    np.testing.assert_allclose(M[-1],bl.bl_stack([elements[0](0.5),elements[1](0.3),rotation(0),elements[3](s[-1]-0.8)]))
+    with pytest.raises(bl.CoupledError):
+        bl.Mblocks(elements,lengths)
+
+def test_errors_are_not_masked():
+    elements,lengths = line()
+    with pytest.raises(ValueError,match='max_points too small'):
+        bl.Mplot(bl.eles_to_peles(elements,[2.]*4,False),lengths,max_points=3)
+
+def scalar_drift(L):
+    '''user element written for scalar lengths only'''
+    return np.array([[1,L,0,0],[0,1,0,0],[0,0,1,L],[0,0,0,1]])
+
+def test_scalar_elements():
+    from functools import partial
+    lengths = [0.5,0.3,0.4]
+    reference = [bl.drift,partial(bl.qf,k=2.),bl.drift]
+    elements = [scalar_drift,partial(bl.qf,k=2.),lambda L: bl.drift(float(L))]
+
+    np.testing.assert_array_equal(bl.Mstack(elements,lengths)[1],bl.Mstack(reference,lengths)[1])
+    np.testing.assert_array_equal(bl.Mplot(elements,lengths,output='array')[1],bl.Mplot(reference,lengths,output='array')[1])
+
+@pytest.mark.parametrize('adaptive',[False,True])
+@pytest.mark.parametrize('max_points',[12,50,333])
+def test_max_points(max_points,adaptive):
+    elements,lengths = line()
+    elements = bl.eles_to_peles(elements,[2.]*4,False)
+
+    s,M = bl.Mplot(elements,lengths,step=1e-4,max_points=max_points,adaptive=adaptive,output='array')
+    assert len(s) <= max_points
+    s_chunks = np.concatenate([s_ for s_,M_ in bl.Mplot_chunks(elements,lengths,chunksize=5,step=1e-4,
+                                                              max_points=max_points,adaptive=adaptive)])
+    np.testing.assert_array_equal(s_chunks,s)
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from ionoptics import bmad
+
+
+def tracking_df(n=3000,seed=0):
+    '''synthetic tracking output: 4 elements, some particles lost (set to 0) at the last two'''
+    rng = np.random.default_rng(seed)
+    names = ['BEGINNING','D1','Q1','D2']
+
+    coords = rng.normal([1e-3,0,-1e-3,0],[1e-3,2e-4,2e-3,3e-4],size=(len(names),n,4))
+    coords[1:,:,1] += 0.3*coords[1:,:,0]
+    coords[2:][:,rng.random(n) < 0.2] = 0
+
+    return pd.DataFrame({'turn':np.repeat([0,1,1,1],n),
+                         'element':pd.Categorical(np.repeat(names,n),categories=names),
+                         's':np.repeat([0.,1.,1.3,2.],n),
+                         'x':coords[...,0].ravel(),'xp':coords[...,1].ravel(),
+                         'y':coords[...,2].ravel(),'yp':coords[...,3].ravel()})
+
+def test_merge_moments():
+    df = tracking_df()
+    # uneven chunks, the first one w/o the last element
+    bounds = [0,1000,9200,9500,len(df)]
+    chunks = [df.iloc[a:b] for a,b in zip(bounds[:-1],bounds[1:])]
+
+    pd.testing.assert_frame_equal(bmad.beam_statistics(chunks),bmad.beam_statistics(df),check_exact=False,rtol=1e-9)
+
+def test_statistics_of_survivors():
+    df = tracking_df()
+    stats = bmad.beam_statistics(df)
+
+    for ele,g in df.groupby('element',observed=True):
+        alive = g[(g[['x','xp','y','yp']] != 0).any(axis=1)]
+        cov = np.cov(alive[['x','xp']].to_numpy().T,bias=True)
+        row = stats.loc[str(ele)]
+
+        assert row['n'] == len(g)
+        np.testing.assert_allclose(row['transmission'],len(alive)/len(g))
+        np.testing.assert_allclose(row['x_mean'],alive['x'].mean())
+        np.testing.assert_allclose(row['x_rms'],alive['x'].std())
+        np.testing.assert_allclose(row['eps_x'],np.sqrt(np.linalg.det(cov)))
+        np.testing.assert_allclose(row['beta_x'],cov[0,0]/np.sqrt(np.linalg.det(cov)))
+
+def write_tracking(path,df):
+    with open(path,'w') as f:
+        for i,row in enumerate(df.itertuples(index=False)):
+            f.write('{} {} {} {!r} {!r} {!r} {!r} {!r}\n'.format(i,row.turn,row.element,row.s,row.x,row.xp,row.y,row.yp))
+    return df.astype({'turn':np.int32})
+
+def test_cache_invalidated_on_change(tmp_path):
+    import os
+    path = tmp_path/'tracking_ele.txt'
+    df = write_tracking(path,tracking_df(n=20))
+    pd.testing.assert_frame_equal(bmad.txt_to_df(str(tmp_path)+'/','tracking_ele.txt'),df,check_categorical=False)
+    pd.testing.assert_frame_equal(bmad.txt_to_df(str(tmp_path)+'/','tracking_ele.txt'),df,check_categorical=False)
+
+    changed = write_tracking(path,tracking_df(n=20,seed=1))
+    st = os.stat(path)
+    os.utime(path,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    pd.testing.assert_frame_equal(bmad.txt_to_df(str(tmp_path)+'/','tracking_ele.txt'),changed,check_categorical=False)
+
+def test_broken_cache_is_reparsed(tmp_path):
+    path = tmp_path/'tracking_ele.txt'
+    df = write_tracking(path,tracking_df(n=20))
+
+    for broken in [b'not a zip file',None]:
+        with open(str(path)+'.npz','wb') as f:
+            if broken is None:
+                np.savez(f,x=np.zeros(3))
+            else:
+                f.write(broken)
+        pd.testing.assert_frame_equal(bmad.txt_to_df(str(tmp_path)+'/','tracking_ele.txt'),df,check_categorical=False)
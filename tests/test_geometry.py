@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from ionoptics import geometry as geo
+
+
+def brute_force_front(objectives):
+    front = np.ones(len(objectives),dtype=bool)
+    for i,p in enumerate(objectives):
+        dominated = np.all(objectives <= p,axis=1) & np.any(objectives < p,axis=1)
+        front[i] = not dominated.any()
+    return front
+
+@pytest.mark.parametrize('dim',[2,3])
+@pytest.mark.parametrize('seed',range(5))
+def test_pareto_front(dim,seed):
+    rng = np.random.default_rng(seed)
+    # integer values: many ties and identical points
+    objectives = rng.integers(0,6,size=(300,dim)).astype(float)
+
+    np.testing.assert_array_equal(geo.pareto_front(objectives),brute_force_front(objectives))
+
+def test_pareto_front_continuous():
+    objectives = np.random.default_rng(0).random((500,3))
+
+    np.testing.assert_array_equal(geo.pareto_front(objectives),brute_force_front(objectives))
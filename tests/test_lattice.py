@@ -0,0 +1,47 @@
+import numpy as np
+from functools import reduce
+from ionoptics.lattice import ProductTree
+
+
+def product(matrices):
+    '''M_n ... M_1 of matrices starting with first element'''
+    return reduce(lambda M,M_next: np.matmul(M_next,M),matrices,np.identity(4))
+
+def test_product_tree():
+    rng = np.random.default_rng(0)
+    matrices = list(rng.normal(size=(7,4,4)))
+    tree = ProductTree(matrices)
+
+    np.testing.assert_allclose(tree.total(),product(matrices))
+    for i in range(len(matrices)+1):
+        for j in range(i,len(matrices)+1):
+            np.testing.assert_allclose(tree.product(i,j),product(matrices[i:j]),atol=1e-12)
+
+def test_product_tree_update():
+    rng = np.random.default_rng(1)
+    matrices = list(rng.normal(size=(5,4,4)))
+    tree = ProductTree(matrices)
+
+    for i in [0,4,2]:
+        matrices[i] = rng.normal(size=(4,4))
+        tree.update(i,matrices[i])
+        np.testing.assert_allclose(tree.total(),product(matrices),atol=1e-12)
+        np.testing.assert_allclose(tree.product(1,4),product(matrices[1:4]),atol=1e-12)
+
+def test_user_elements_not_cached():
+    from functools import partial
+    from ionoptics import beamline as bl
+    from ionoptics.lattice import Lattice, LRUCache
+
+    params = {'k':2.}
+    quad = lambda L: bl.qf(L,params['k'])
+    cache = LRUCache()
+
+    np.testing.assert_allclose(Lattice([quad],[0.3],cache).total_matrix(),bl.qf(0.3,2.))
+    params['k'] = 3.
+    np.testing.assert_allclose(Lattice([quad],[0.3],cache).total_matrix(),bl.qf(0.3,3.))
+    assert len(cache) == 0
+
+    Lattice([partial(bl.qf,k=2.),bl.drift],[0.3,1.],cache).total_matrix()
+    Lattice([partial(bl.qf,k=2.),bl.drift],[0.3,1.],cache).total_matrix()
+    assert (len(cache),cache.hits) == (2,2)
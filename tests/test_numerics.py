@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from helpers import numerics as num
+
+
+def two_windows(var1,var2):
+    '''threshold 0.5 reached on [1,2] and above 5'''
+    return np.where(((var2 >= 1) & (var2 <= 2)) | (var2 > 5),0.,1.)+0*var1
+
+def test_solve_first_crossing():
+    d = num.solve(two_windows,[0.,1.],0.,0.2,0.5,tol=1e-9)
+    np.testing.assert_allclose(list(d.values()),1.,atol=1e-9)
+    assert num.iterate(two_windows,[0.],0.,0.2,0.5)[0.] == 1.
+
+@pytest.mark.parametrize('step',[1e-2,1e-4,1e-8])
+def test_solve_precision_independent_of_step(step):
+    line = lambda var1,var2: 2-50*var2+var1
+    d = num.solve(line,[0.,0.5],1e-3,step,0,tol=1e-9)
+    np.testing.assert_allclose([d[0.],d[0.5]],[0.04,0.05],atol=1e-9)
+
+def test_solve_at_start():
+    assert num.solve(lambda var1,var2: 0*var1,[0.],3.,0.1,1.) == {0.: 3.}
+
+def test_solve_not_reached():
+    with pytest.warns(RuntimeWarning):
+        d = num.solve(lambda var1,var2: 1+0*var1*var2,[0.],0.,1.,0.5,max_doublings=8)
+    assert np.isnan(d[0.])
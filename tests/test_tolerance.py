@@ -0,0 +1,15 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ionoptics import beamline as bl
+from ionoptics import tolerance
+
+
+@pytest.mark.parametrize('chunksize',[1000,1024,3000])
+def test_independent_of_chunksize(chunksize):
+    elements = bl.eles_to_peles([bl.drift,bl.qf,bl.drift,bl.qdf,bl.drift],[2.,3.],False)
+    lengths = [0.5,0.3,0.25,0.3,1.]
+    study = lambda chunksize: tolerance.tolerance_study(elements,lengths,n=2500,sigma_l=1e-3,seed=1,
+                                                        chunksize=chunksize,processes=1)
+
+    pd.testing.assert_frame_equal(study(chunksize),study(2500))
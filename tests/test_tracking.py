@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+from functools import partial
+from ionoptics import beamline as bl
+from ionoptics import tracking
+
+
+def test_track_independent_of_chunksize():
+    rng = np.random.default_rng(0)
+    particles = rng.normal(0,1e-3,size=(25,4))
+    elements = [bl.drift,partial(bl.qf,k=2.),bl.drift,partial(bl.qdf,k=2.),bl.drift]
+    lengths = [0.5,0.3,0.,0.3,1.]
+    apertures = {1:('ellipse',1e-3,1e-3)}
+
+    df = tracking.track(particles,elements,lengths,apertures,chunksize=len(particles))
+    for chunksize in [1,7,10]:
+        pd.testing.assert_frame_equal(tracking.track(particles,elements,lengths,apertures,chunksize=chunksize),df)